@@ -9,12 +9,20 @@ import json
 import pandas as pd
 
 from tqdm import tqdm
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Union
 
 from models.claude import ClaudeAPI
 from models.gpt import OpenAIAPI
+from models.fake import FakeAPI, LocalBatchTransport
+from models.batch import BatchRunner, AnthropicBatchTransport
+from models.router import RouterAPI, Provider
 from utils.image import Image_
 from utils.mongo import Mongo
+from utils.pipeline import InferencePipeline
+from utils.rate_limit import RateLimiter
+from utils.cache import InferenceCache
+from utils.encoding import PayloadEncoder
+from utils.prefilter import LayoutPrefilter
 from utils.utils import *
 from utils.args import Arguments
 
@@ -28,25 +36,229 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+DEFAULT_MODEL_NAMES = {
+    "sonnet": "claude-3-5-sonnet-20241022",
+    "gpt": "gpt-4o",
+    "fake": "fake",
+}
+
+def load_model(args: argparse.Namespace, cache: Optional[InferenceCache] = None):
+    hedge_after = None
+    if args.hedge_after:
+        hedge_after = args.hedge_after if args.hedge_after == "p95" else float(args.hedge_after)
+
+    if args.model != "router":
+        model_name = args.model_name or DEFAULT_MODEL_NAMES.get(args.model)
+        return load_backend(args, args.model, model_name, cache=cache, hedge_after=hedge_after)
+
+    # Each provider is "model[:model_name[:max_in_flight]]"
+    providers = []
+    for spec in args.router_providers.split(","):
+        kind, model_name, max_in_flight = (spec.split(":") + [None, None])[:3]
+        backend = load_backend(args, kind, model_name or DEFAULT_MODEL_NAMES.get(kind), hedge_after=hedge_after)
+        providers.append(Provider(backend, max_in_flight=int(max_in_flight or args.max_in_flight)))
+    return RouterAPI(providers, prompt_type=args.prompt_type, cache=cache)
+
+def load_backend(
+    args: argparse.Namespace,
+    kind: str,
+    model_name: str,
+    cache: Optional[InferenceCache] = None,
+    hedge_after: Optional[Union[float, str]] = None
+):
+    rate_limiter = None
+    if args.requests_per_minute > 0:
+        rate_limiter = RateLimiter.shared(
+            f"{kind}:{model_name}",
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute
+        )
+
+    if kind == "sonnet":
+        return ClaudeAPI(
+            model_name=model_name, prompt_type=args.prompt_type, tool=args.tool, base_url=args.api_base_url,
+            rate_limiter=rate_limiter, cache=cache, hedge_after=hedge_after, prompt_caching=args.prompt_caching,
+            stream=args.stream, max_tokens=args.max_tokens or None
+        )
+    if kind == "gpt":
+        return OpenAIAPI(
+            model_name=model_name, prompt_type=args.prompt_type, tool=args.tool, base_url=args.api_base_url,
+            rate_limiter=rate_limiter, cache=cache, hedge_after=hedge_after, max_tokens=args.max_tokens or None
+        )
+    if kind == "fake":
+        return FakeAPI(
+            model_name=model_name, prompt_type=args.prompt_type, tool=args.tool,
+            rate_limiter=rate_limiter, cache=cache, hedge_after=hedge_after, max_tokens=args.max_tokens or None
+        )
+    raise ValueError(
+        f"Invalid model: {kind}. "
+        f"Available models are: {', '.join(list(DEFAULT_MODEL_NAMES.keys()) + ['router'])}"
+    )
+
+def load_database(args: argparse.Namespace) -> Mongo:
+    return Mongo(
+        connection_uri=os.getenv("MONGO_URI"),
+        query_check=args.mongo_query_check,
+        # One connection per worker thread plus the prefetching main thread
+        max_pool_size=args.mongo_max_pool_size or args.max_in_flight + 1,
+        connect_timeout_ms=args.mongo_timeout_ms,
+        server_selection_timeout_ms=args.mongo_timeout_ms,
+        write_concern=args.mongo_write_concern or None,
+        compressors=args.mongo_compressors or None
+    )
+
+def build_preprocess(args: argparse.Namespace, database: Optional[Mongo] = None):
+    encoder = None
+    if args.encode_formats:
+        encoder = PayloadEncoder(
+            formats=args.encode_formats.split(","),
+            max_bytes=args.max_payload_bytes,
+            max_tokens=args.max_image_tokens,
+            grayscale=args.grayscale
+        )
+    if encoder is None and not args.rotate_crop:
+        return None
+
+    def preprocess(image: Image_) -> Image_:
+        if args.rotate_crop:
+            metadata = database.extract_metadata(image.get_path())
+            if metadata is not None:
+                image.rotate(metadata["rotation"]).crop(metadata["corners"])
+        return image.set_encoder(encoder)
+
+    return preprocess
+
+def build_prefilter(args: argparse.Namespace) -> Optional[LayoutPrefilter]:
+    if args.prefilter_threshold <= 0:
+        return None
+    if args.prompt_type != "Classifier":
+        logger.warning("The layout prefilter only applies to the Classifier prompt, ignoring it")
+        return None
+    return LayoutPrefilter(threshold=args.prefilter_threshold)
+
+def with_prefetched_metadata(file_paths: Iterable[str], database: Mongo, chunk_size: int) -> Iterator[str]:
+    """Yields paths after loading their metadata a chunk at a time, so the per-image lookup stays in memory."""
+    for chunk in chunked(file_paths, chunk_size):
+        database.prefetch_metadata(chunk, chunk_size=chunk_size)
+        yield from chunk
+
+def run_batch(args: argparse.Namespace, model, file_paths: List[str], database: Optional[Mongo]) -> None:
+    if isinstance(model, ClaudeAPI):
+        transport = AnthropicBatchTransport(model.client)
+    elif isinstance(model, FakeAPI):
+        transport = LocalBatchTransport(os.path.join(args.batch_dir, "server"))
+    else:
+        raise ValueError(f"Batch mode is not supported for model: {args.model}")
+
+    runner = BatchRunner(
+        model=model,
+        transport=transport,
+        work_dir=args.batch_dir,
+        chunk_size=args.batch_chunk_size,
+        poll_interval=args.batch_poll_interval,
+        preprocess=build_preprocess(args, database)
+    )
+    if args.rotate_crop:
+        database.prefetch_metadata(file_paths, chunk_size=args.prefetch_chunk_size)
+    outputs = runner.run(file_paths)
+
+    rows = [
+        [idx, os.path.basename(os.path.dirname(file_path)), os.path.basename(file_path), output, None, "batch"]
+        for idx, (file_path, output) in enumerate(zip(file_paths, outputs))
+    ]
+    save_to_csv(args.output_csv, rows, InferencePipeline.HEADERS, mode='w')
+    logger.info("Batch run finished, results saved to %s", args.output_csv)
+
+def export_telemetry(args: argparse.Namespace, model) -> None:
+    summary = model.telemetry.summary()
+    metrics = summary["metrics"]
+    latency = metrics["latency_s"]
+    logger.info(
+        "Run summary: %d pages, %s img/s, latency p50 %s p95 %s p99 %s, $%.4f total, $%s per 1k pages, "
+        "input tokens per request %s estimated / %s billed",
+        summary["pages"], _fmt(summary["images_per_sec"]), _fmt(latency["p50"]), _fmt(latency["p95"]),
+        _fmt(latency["p99"]), summary["total_cost_usd"], _fmt(summary["cost_per_1k_pages_usd"]),
+        _fmt(metrics["estimated_input_tokens"]["mean"]), _fmt(metrics["input_tokens"]["mean"])
+    )
+    if not args.telemetry_path:
+        return
+    model.telemetry.export_json(args.telemetry_path + ".json")
+    model.telemetry.export_csv(
+        args.telemetry_path + ".csv",
+        model=model.model_name,
+        prompt_type=args.prompt_type,
+        max_in_flight=args.max_in_flight,
+        max_image_tokens=args.max_image_tokens,
+        max_payload_bytes=args.max_payload_bytes
+    )
+    logger.info("Telemetry saved to %s.json and %s.csv", args.telemetry_path, args.telemetry_path)
+
+def _fmt(value: Optional[float]) -> str:
+    return "n/a" if value is None else f"{value:.3f}"
+
 def main() -> None:
     ## Load the arguments ##
     args = Arguments.parse_arguments()
-    model = args.model
-    sources_traductor = args.sources_traductor
-
-    sources_traductor = get_list(sources_traductor)
+    # Paths are streamed, so the first request goes out while the folder is still being listed
+    sources_traductor = scan_images(
+        args.sources_traductor,
+        recursive=args.recursive,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count
+    )
 
     ## Load the database ##
-    database = Mongo(connection_uri=os.getenv("MONGO_URI"))
+    database = None
+    if args.rotate_crop or args.mongo_ensure_indexes:
+        # Connects on first query, not here
+        database = load_database(args)
+        if args.mongo_ensure_indexes:
+            database.ensure_indexes()
 
     # ## Load the model ##
     logger.info("Initializing model...")
+    cache = InferenceCache(args.cache_path, max_entries=args.cache_max_entries) if args.cache_path else None
+    model = load_model(args, cache=cache)
+    if args.pages_per_request > 1 and not args.batch_dir:
+        if not isinstance(model, (ClaudeAPI, FakeAPI)):
+            raise ValueError(f"Packing several pages per request is not supported for model: {args.model}")
+        if args.tool:
+            raise ValueError("Packed pages answer in labeled text and cannot be combined with --tool")
+
+    if args.batch_dir:
+        # Batch state is keyed on the full ordered list, so it has to be stable across reruns
+        run_batch(args, model, sorted(sources_traductor), database)
+    else:
+        pipeline = InferencePipeline(
+            model=model,
+            output_csv=args.output_csv,
+            max_in_flight=args.max_in_flight,
+            preprocess=build_preprocess(args, database),
+            preprocess_workers=args.preprocess_workers,
+            queue_size=args.preprocess_queue_size or None,
+            request_timeout=args.request_timeout,
+            prefilter=build_prefilter(args),
+            pages_per_request=args.pages_per_request
+        )
+        file_paths = sources_traductor
+        if args.rotate_crop:
+            file_paths = with_prefetched_metadata(sources_traductor, database, args.prefetch_chunk_size)
+        with tqdm(desc="Processing sources-traductor images", unit="img") as progress:
+            pipeline.run(file_paths, progress=progress)
 
-    for idx, file_path in enumerate(tqdm(sources_traductor, desc="Processing sources-traductor images")):
-        print("#"*50)
-        image_name = os.path.basename(file_path)
-        logger.debug(f"Processing image: {image_name}")
-        image = Image_(path=file_path)
+    export_telemetry(args, model)
+    if isinstance(model, RouterAPI):
+        for provider in model.providers:
+            summary = provider.backend.telemetry.summary()
+            logger.info(
+                "Provider %s: %d pages, %d failed, $%.4f",
+                provider.name, summary["pages"], summary["failures"], summary["total_cost_usd"]
+            )
+    if cache is not None:
+        logger.info("Inference cache: %s", cache.stats())
+        cache.close()
+    if database is not None:
+        database.close()
 
 
 if __name__ == "__main__":
@@ -1,21 +1,87 @@
+import re
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple, Union
+
 from dotenv import load_dotenv
-from utils.prompts import prompts, tools
+from utils.prompts import prompts, tools, output_budgets
+from utils.rate_limit import RateLimiter, Backoff, is_retryable, is_rate_limited, get_retry_after
+from utils.cache import InferenceCache
+from utils.telemetry import Telemetry
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Start of a page's answer in a packed response: "Page 2:", "**Page 2**", "## Page 2 -"...
+PAGE_HEADER = re.compile(r"^[\s*#>-]*page\s+(\d+)\b[\s*:.\-]*", re.IGNORECASE | re.MULTILINE)
+# Classifier answers, by lowercased line
+CLASSIFIER_LABELS = {"no candidate": "No Candidate", "candidate": "Candidate"}
+
+class Usage(NamedTuple):
+    input_tokens: int
+    output_tokens: int
+
+class InferenceCancelled(Exception):
+    """Raised inside `_send` when the backend is shutting down."""
+
+
 class BaseAPI:
-    def __init__(self, model_name: str, prompt_type: str, tool: str):
+    # USD per input / output token, set by each backend
+    INPUT_COST = 0.0
+    OUTPUT_COST = 0.0
+    # Completed requests needed before an adaptive ("p95") hedge delay is trusted
+    HEDGE_MIN_SAMPLES = 20
+    # Threads running requests when hedging; created on demand, so this is only a ceiling
+    HEDGE_MAX_WORKERS = 256
+    # Output tokens of prompts without an entry in `output_budgets`
+    DEFAULT_MAX_TOKENS = 1024
+
+    def __init__(
+        self,
+        model_name: str,
+        prompt_type: str,
+        tool: str,
+        rate_limiter: Optional[RateLimiter] = None,
+        backoff: Optional[Backoff] = None,
+        cache: Optional[InferenceCache] = None,
+        telemetry: Optional[Telemetry] = None,
+        hedge_after: Optional[Union[float, str]] = None,
+        max_tokens: Optional[int] = None
+    ):
+        """
+        With `hedge_after`, a request still pending after that many seconds is
+        sent a second time and whichever copy answers first wins. "p95" uses
+        the 95th percentile latency seen so far in this run.
+        `max_tokens` overrides the output budget of the prompt.
+        """
         self.model_name = model_name
         self.prompt_type = prompt_type
         self.prompt_dict = prompts
         self.prompt = None
         self.tool = tools
+        self.rate_limiter = rate_limiter
+        self.backoff = backoff or Backoff()
+        self.cache = cache
+        self.telemetry = telemetry or Telemetry()
+        if hedge_after is not None and hedge_after != "p95" and float(hedge_after) <= 0:
+            raise ValueError(f"hedge_after must be positive or 'p95', got {hedge_after}.")
+        self.hedge_after = hedge_after
+        self._hedge_pool: Optional[ThreadPoolExecutor] = None
+        self._hedge_lock = threading.Lock()
+        self._p95: Optional[float] = None
+        self._p95_samples = 0
+        self._shutdown = threading.Event()
+        self.max_tokens_override = max_tokens
         self.set_prompt(prompt_type)
         self.set_tool(tool)
 
     def set_prompt(self, prompt_type: str):
         if prompt_type in self.prompt_dict:
             self.prompt = self.prompt_dict[prompt_type]
+            self.max_tokens = self.max_tokens_override or output_budgets.get(prompt_type, self.DEFAULT_MAX_TOKENS)
         else:
             raise ValueError(
                 f"Invalid prompt type: {prompt_type}. "
@@ -23,7 +89,9 @@ class BaseAPI:
             )
 
     def set_tool(self, tool: str):
-        if tool in self.tool:
+        if tool is None:
+            self.tool = None
+        elif tool in self.tool:
             self.tool = self.tool[tool]
         else:
             raise ValueError(
@@ -31,10 +99,353 @@ class BaseAPI:
                 f"Available tools are: {', '.join(self.tool.keys())}"
             )
 
+    def run_inference(self, image, max_retries=3, timeout=15) -> Optional[str]:
+        """
+        Sends the prompt and image through `_send`, waiting on the shared rate
+        limiter first and backing off between retries of transient errors.
+        Results are served from and stored in the cache when one is set.
+        Latency, retries, tokens, uploaded bytes and cost are recorded in
+        `telemetry`. `timeout` is enforced by the client on each attempt.
+        Returns None when every attempt failed or the backend was cancelled.
+        """
+        self._check_image(image)
+        start_time = self.telemetry.start()
+        cache_key, cached = self._cache_lookup(image)
+        if cached is not None:
+            return cached
+
+        estimate = self.estimate_input_tokens(image)
+        self.telemetry.record_estimate(estimate)
+        logger.debug("Estimated input tokens for image %s: %d", image.get_path(), estimate)
+        return self._infer(image, cache_key, start_time, max_retries, timeout)
 
-    def run_inference(self, image_data: bytes):
+    def run_inference_pages(self, images: List[Any], max_retries=3, timeout=15) -> List[Optional[str]]:
+        """
+        Answers several images with a single request through `_send_pages`:
+        the prompt is sent once and the model labels its answer for each page.
+        Cached pages are left out of the request, and pages the answer does
+        not label are sent again on their own. Packed requests are not hedged.
+        Returns one answer per image, None where it failed.
+        """
+        if len(images) == 1:
+            return [self.run_inference(images[0], max_retries, timeout)]
+        for image in images:
+            self._check_image(image)
+
+        start_time = self.telemetry.start()
+        answers: List[Optional[str]] = []
+        keys: List[Optional[str]] = []
+        for image in images:
+            cache_key, cached = self._cache_lookup(image)
+            answers.append(cached)
+            keys.append(cache_key)
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        if len(pending) == 1:
+            i = pending[0]
+            answers[i] = self._infer(images[i], keys[i], start_time, max_retries, timeout)
+            return answers
+        if not pending:
+            return answers
+
+        batch = [images[i] for i in pending]
+        self.telemetry.record_estimate(self.estimate_input_tokens(*batch))
+        outputs = self._request(
+            lambda: self._send_pages(batch, timeout),
+            ", ".join(image.get_path() for image in batch),
+            lambda: sum(len(image.get_base64()) for image in batch),
+            start_time,
+            max_retries,
+            # Unlabeled pages are counted by their own request
+            count_pages=lambda outputs: len(batch) if outputs is None else sum(o is not None for o in outputs)
+        )
+        if outputs is None:
+            return answers
+
+        for i, output in zip(pending, outputs):
+            if output is None:
+                logger.warning("No labeled answer for page %s, sending it on its own", images[i].get_path())
+                output = self._infer(images[i], keys[i], self.telemetry.start(), max_retries, timeout)
+            elif keys[i] is not None:
+                self.cache.put(keys[i], output)
+            answers[i] = output
+        return answers
+
+    @staticmethod
+    def _check_image(image) -> None:
+        if not hasattr(image, 'get_type') or not hasattr(image, 'get_base64'):
+            raise TypeError("Image must have get_type() and get_base64() methods.")
+
+    def _cache_lookup(self, image) -> Tuple[Optional[str], Optional[str]]:
+        """The cache key of `image` and its cached answer, (None, None) without a cache."""
+        if self.cache is None:
+            return None, None
+        cache_key = self.cache.make_key(
+            image.get_base64(), image.get_type(), self.prompt, self.model_name, self.tool
+        )
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Cache hit for image %s", image.get_path())
+            self.telemetry.record_cache_hit()
+        return cache_key, cached
+
+    def _infer(self, image, cache_key: Optional[str], start_time: float, max_retries: int, timeout: float) -> Optional[str]:
+        output = self._request(
+            lambda: self._send_hedged(image, timeout),
+            image.get_path(),
+            lambda: len(image.get_base64()),
+            start_time,
+            max_retries
+        )
+        if cache_key is not None and output is not None:
+            self.cache.put(cache_key, output)
+        return output
+
+    def _request(
+        self,
+        send: Callable[[], Tuple[Any, Any]],
+        name: str,
+        payload_bytes: Callable[[], int],
+        start_time: float,
+        max_retries: int,
+        count_pages: Optional[Callable[[Any], int]] = None
+    ) -> Any:
+        """
+        Calls `send` until it succeeds, with rate limiting, backoff and
+        telemetry. `count_pages` gives the pages answered by an output
+        (None when the request failed); one page per request by default.
+        """
+        count_pages = count_pages or (lambda output: 1)
+        bytes_uploaded = 0
+        for attempt in range(max_retries + 1):
+            if self._shutdown.is_set():
+                logger.info("Inference cancelled for image %s", name)
+                self.telemetry.record(
+                    start_time, retries=attempt, bytes_uploaded=bytes_uploaded, failed=True, pages=count_pages(None)
+                )
+                return None
+            reserved = self.rate_limiter.acquire() if self.rate_limiter else 0
+            try:
+                bytes_uploaded += payload_bytes()
+                output, usage = send()
+            except Exception as e:
+                if self.rate_limiter:
+                    self.rate_limiter.release(reserved)
+                if isinstance(e, InferenceCancelled) or self._shutdown.is_set():
+                    logger.info("Inference cancelled for image %s", name)
+                    self.telemetry.record(
+                        start_time, retries=attempt, bytes_uploaded=bytes_uploaded, failed=True, pages=count_pages(None)
+                    )
+                    return None
+                if not is_retryable(e) or attempt == max_retries:
+                    logger.error("All inference attempts failed for image -> %s: %s", name, e)
+                    self.telemetry.record(
+                        start_time, retries=attempt, bytes_uploaded=bytes_uploaded, failed=True, pages=count_pages(None)
+                    )
+                    return None
+
+                delay = self.backoff.delay(attempt, get_retry_after(e))
+                if self.rate_limiter and is_rate_limited(e):
+                    self.rate_limiter.pause(delay)
+                logger.warning(
+                    "Inference failed with error: %s. Retrying in %.1fs... (%d retries left)",
+                    e, delay, max_retries - attempt
+                )
+                # Woken early by cancel()
+                self._shutdown.wait(delay)
+                continue
+
+            if self.rate_limiter:
+                self.rate_limiter.record_usage(usage.input_tokens, usage.output_tokens, reserved)
+            self.telemetry.record(
+                start_time,
+                retries=attempt,
+                input_tokens=usage.input_tokens,
+                output_tokens=usage.output_tokens,
+                bytes_uploaded=bytes_uploaded,
+                cost=self.cost(usage),
+                pages=count_pages(output)
+            )
+            return output
+        return None
+
+    def _send_hedged(self, image, timeout: float) -> Tuple[str, Any]:
+        """
+        `_send`, duplicated once the hedge delay has passed without an answer.
+        The first successful copy is returned and settled by the caller
+        against its reservation; the other one keeps running in the
+        background and is settled against the hedge's reservation.
+        """
+        delay = self._hedge_delay()
+        if delay is None:
+            return self._send(image, timeout)
+
+        primary = self._get_hedge_pool().submit(self._send, image, timeout)
+        done, _ = wait([primary], timeout=delay)
+        if done or self._shutdown.is_set():
+            return primary.result()
+
+        logger.debug("No answer for %s after %.2fs, sending a hedged request", image.get_path(), delay)
+        reserved = self.rate_limiter.acquire() if self.rate_limiter else 0
+        hedge = self._get_hedge_pool().submit(self._send, image, timeout)
+
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.telemetry.record_hedge(won=future is hedge)
+                    loser = primary if future is hedge else hedge
+                    loser.add_done_callback(lambda f: self._settle_hedge(f, reserved))
+                    return future.result()
+                error = future.exception()
+        # Neither copy answered; the caller releases its own reservation
+        if self.rate_limiter:
+            self.rate_limiter.release(reserved)
+        raise error
+
+    def _settle_hedge(self, future: Future, reserved: int) -> None:
+        """Accounts for the copy that lost the race, whichever one it was."""
+        if future.cancelled() or future.exception() is not None:
+            if self.rate_limiter:
+                self.rate_limiter.release(reserved)
+            return
+        _, usage = future.result()
+        if self.rate_limiter:
+            self.rate_limiter.record_usage(usage.input_tokens, usage.output_tokens, reserved)
+        self.telemetry.record_hedge_cost(self.cost(usage))
+
+    def _hedge_delay(self) -> Optional[float]:
+        if self.hedge_after is None:
+            return None
+        if self.hedge_after != "p95":
+            return float(self.hedge_after)
+
+        latencies = self.telemetry.histograms["latency_s"]
+        samples = len(latencies)
+        if samples < self.HEDGE_MIN_SAMPLES:
+            return None
+        with self._hedge_lock:
+            # Re-sorting every sample on each request is wasteful, refresh every 5%
+            if self._p95 is None or samples - self._p95_samples > max(10, self._p95_samples // 20):
+                self._p95 = latencies.percentile(95)
+                self._p95_samples = samples
+            return self._p95
+
+    def _get_hedge_pool(self) -> ThreadPoolExecutor:
+        with self._hedge_lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(max_workers=self.HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+            return self._hedge_pool
+
+    def cancel(self) -> None:
+        """
+        Stops the backend: pending retries and hedges are dropped, later
+        `run_inference` calls return None, and requests already on the wire
+        are aborted where the client supports it.
+        """
+        if self._shutdown.is_set():
+            return
+        logger.warning("Cancelling %s requests", self.model_name)
+        self._shutdown.set()
+        self._abort_requests()
+        if self._hedge_pool is not None:
+            self._hedge_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _abort_requests(self) -> None:
+        # Closing the HTTP connection pool makes pending requests fail right away
+        client = getattr(self, "client", None)
+        if client is not None:
+            client.close()
+
+    def cost(self, usage) -> float:
+        """USD cost of a request from its token usage."""
+        return usage.input_tokens * self.INPUT_COST + usage.output_tokens * self.OUTPUT_COST
+
+    def estimate_input_tokens(self, *images) -> int:
+        """Rough input token count of a request for `images`, known before it is sent."""
+        image_tokens = sum(image.estimate_tokens() for image in images if hasattr(image, 'estimate_tokens'))
+        return image_tokens + len(self.prompt) // 4
+
+    def pages_instruction(self, count: int) -> str:
+        """Asks for one labeled answer per page of a packed request."""
+        return (
+            f"The {count} images above are separate pages, each introduced by its label "
+            f"\"Page 1\" to \"Page {count}\". Follow the instructions for every page on its own. "
+            f"Start the answer for each page on a new line with its label and a colon, "
+            f"e.g. \"Page 1: <answer>\", and give every page an answer."
+        )
+
+    def _split_pages(self, raw_output: str, count: int) -> List[Optional[str]]:
+        """Cleaned answer of each page in a packed response, None for the pages it does not label."""
+        answers: List[Optional[str]] = [None] * count
+        headers = list(PAGE_HEADER.finditer(raw_output))
+        for header, following in zip(headers, headers[1:] + [None]):
+            page = int(header.group(1))
+            if not 1 <= page <= count or answers[page - 1] is not None:
+                continue
+            answer = raw_output[header.end():following.start() if following else len(raw_output)]
+            answer = answer.strip().strip('*"`\'').strip()
+            if answer:
+                answers[page - 1] = self._clean_output(answer)
+        return answers
+
+    def _early_label(self, partial_output: str) -> Optional[str]:
+        """The Classifier label once a complete line of a streamed answer states it, else None."""
+        for line in partial_output.split("\n")[:-1]:
+            label = CLASSIFIER_LABELS.get(line.strip().lower())
+            if label is not None:
+                return label
+        return None
+
+    def _tool_output(self, arguments: Any) -> str:
+        """
+        The JSON answer carried by a tool call. Tool inputs are objects, so
+        an input with a single required property (e.g. "pairs") is unwrapped.
+        """
+        required = self.tool[0]["input_schema"].get("required", [])
+        if len(required) == 1 and isinstance(arguments, dict):
+            arguments = arguments.get(required[0], [])
+        return json.dumps(arguments, ensure_ascii=False)
+
+    def _clean_output(self, raw_output):
+        """Normalises a backend's text answer: the Classifier label, or the JSON array for extraction prompts."""
+        if self.prompt_type == "Classifier":
+            lines = raw_output.strip().split("\n")
+            # Check for "no candidate" or "candidate"
+            for line in lines:
+                line_stripped = line.strip().lower()
+                if line_stripped == "no candidate":
+                    return "No Candidate"
+            for line in lines:
+                line_stripped = line.strip().lower()
+                if line_stripped == "candidate":
+                    return "Candidate"
+
+        # Attempt to extract JSON array from raw_output
+        start_index = raw_output.find('[')
+        end_index = raw_output.rfind(']')
+
+        # If a valid JSON structure is found, return just the JSON portion
+        if start_index != -1 and end_index != -1 and end_index > start_index:
+            json_str = raw_output[start_index:end_index+1].strip()
+            return json_str
+
+        # If no JSON extraction was possible, return the raw output
+        return raw_output
+
+    def _send(self, image, timeout: float) -> Tuple[str, Any]:
         """
         Implemented in subclasses to send the prompt and image to the respective API.
-        Should return a string response.
+        Should return the cleaned response and the usage object with
+        `input_tokens` and `output_tokens`.
+        """
+        raise NotImplementedError
+
+    def _send_pages(self, images: List[Any], timeout: float) -> Tuple[List[Optional[str]], Any]:
+        """
+        Implemented in subclasses that can pack several images in one request.
+        Should return one cleaned answer per image (None for the pages the
+        response does not label, see `_split_pages`) and the usage object.
         """
         raise NotImplementedError
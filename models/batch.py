@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from utils.image import Image_
+
+logger = logging.getLogger(__name__)
+
+class BatchTransport:
+    """
+    Service that runs batches of `messages.create` requests. Results are
+    yielded as (custom_id, message) pairs, with message None for failed requests.
+    """
+    def submit(self, requests: List[Dict[str, Any]]) -> str:
+        raise NotImplementedError
+
+    def is_done(self, batch_id: str) -> bool:
+        raise NotImplementedError
+
+    def results(self, batch_id: str) -> Iterator[Tuple[str, Any]]:
+        raise NotImplementedError
+
+
+class AnthropicBatchTransport(BatchTransport):
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, requests: List[Dict[str, Any]]) -> str:
+        return self.client.messages.batches.create(requests=requests).id
+
+    def is_done(self, batch_id: str) -> bool:
+        return self.client.messages.batches.retrieve(batch_id).processing_status == "ended"
+
+    def results(self, batch_id: str) -> Iterator[Tuple[str, Any]]:
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                yield entry.custom_id, entry.result.message
+            else:
+                logger.warning("Batch request %s finished as '%s'", entry.custom_id, entry.result.type)
+                yield entry.custom_id, None
+
+
+class BatchRunner:
+    """
+    Offline classification through a batch API. Request files are built per
+    chunk of images, submitted, polled until done and merged back in input
+    order. Progress is kept in `work_dir/state.json`, so a run that dies can
+    be resumed by calling `run` again with the same inputs. Results collected
+    by this call are recorded in `model.telemetry`, with latency measured
+    from the start of `run`.
+    """
+    # Batch requests are billed at half the standard token prices
+    PRICE_FACTOR = 0.5
+
+    def __init__(
+        self,
+        model,
+        transport: BatchTransport,
+        work_dir: str,
+        chunk_size: int = 100,
+        poll_interval: float = 30.0,
+        preprocess: Optional[Callable[[Image_], Image_]] = None
+    ):
+        self.model = model
+        self.transport = transport
+        self.work_dir = work_dir
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.preprocess = preprocess
+        self.state_path = os.path.join(work_dir, "state.json")
+        os.makedirs(work_dir, exist_ok=True)
+
+    def run(self, file_paths: List[str]) -> List[Optional[str]]:
+        state = self._load_state(file_paths)
+        start_time = self.model.telemetry.start()
+
+        for chunk in state["chunks"]:
+            if chunk["batch_id"] is None:
+                requests_path = self._build_requests(file_paths, chunk)
+                with open(requests_path) as f:
+                    requests = [json.loads(line) for line in f if line.strip()]
+                if not requests:
+                    logger.warning("Chunk %d has no valid images, skipping it.", chunk["index"])
+                    self._write_atomic(self._chunk_path("results", chunk), "")
+                    chunk["batch_id"] = ""
+                    chunk["done"] = True
+                    self._save_state(state)
+                    continue
+                chunk["batch_id"] = self.transport.submit(requests)
+                self._save_state(state)
+                logger.info("Submitted chunk %d as batch %s (%d requests)", chunk["index"], chunk["batch_id"], len(requests))
+
+        pending = [chunk for chunk in state["chunks"] if not chunk["done"]]
+        while pending:
+            for chunk in pending:
+                if self.transport.is_done(chunk["batch_id"]):
+                    self._save_results(chunk, start_time)
+                    chunk["done"] = True
+                    self._save_state(state)
+                    logger.info("Batch %s finished", chunk["batch_id"])
+            pending = [chunk for chunk in pending if not chunk["done"]]
+            if pending:
+                logger.info("Waiting on %d batches...", len(pending))
+                time.sleep(self.poll_interval)
+
+        return self._merge(state, len(file_paths))
+
+    @staticmethod
+    def _custom_id(idx: int) -> str:
+        return f"img-{idx:08d}"
+
+    def _chunk_path(self, kind: str, chunk: Dict[str, Any]) -> str:
+        return os.path.join(self.work_dir, f"{kind}_{chunk['index']:05d}.jsonl")
+
+    def _load_state(self, file_paths: List[str]) -> Dict[str, Any]:
+        digest = hashlib.sha256("\n".join(file_paths).encode("utf-8")).hexdigest()
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state["inputs_digest"] == digest:
+                logger.info("Resuming batch run from %s", self.state_path)
+                return state
+            raise ValueError(
+                f"{self.state_path} belongs to a different set of inputs. "
+                "Use a new work directory or remove it to start over."
+            )
+
+        chunks = [
+            {"index": i, "start": start, "end": min(start + self.chunk_size, len(file_paths)), "batch_id": None, "done": False}
+            for i, start in enumerate(range(0, len(file_paths), self.chunk_size))
+        ]
+        state = {"inputs_digest": digest, "chunks": chunks}
+        self._save_state(state)
+        return state
+
+    def _save_state(self, state: Dict[str, Any]) -> None:
+        self._write_atomic(self.state_path, json.dumps(state, indent=4))
+
+    @staticmethod
+    def _write_atomic(path: str, content: str) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _build_requests(self, file_paths: List[str], chunk: Dict[str, Any]) -> str:
+        requests_path = self._chunk_path("requests", chunk)
+        if os.path.isfile(requests_path):
+            return requests_path
+
+        lines = []
+        for idx in range(chunk["start"], chunk["end"]):
+            try:
+                image = Image_(path=file_paths[idx])
+                if self.preprocess is not None:
+                    image = self.preprocess(image)
+                request = {"custom_id": self._custom_id(idx), "params": self.model.build_request(image)}
+            except Exception as e:
+                logger.exception("Image %s failed, leaving it out of the batch: %s", file_paths[idx], e)
+                continue
+            lines.append(json.dumps(request))
+        self._write_atomic(requests_path, "\n".join(lines) + "\n")
+        return requests_path
+
+    def _save_results(self, chunk: Dict[str, Any], start_time: float) -> None:
+        lines = []
+        for custom_id, message in self.transport.results(chunk["batch_id"]):
+            output = self.model.parse_message(message) if message is not None else None
+            self._record(message, start_time)
+            lines.append(json.dumps({"custom_id": custom_id, "output": output}))
+        self._write_atomic(self._chunk_path("results", chunk), "\n".join(lines) + "\n")
+
+    def _record(self, message: Any, start_time: float) -> None:
+        if message is None:
+            self.model.telemetry.record(start_time, failed=True)
+            return
+        usage = message.usage
+        self.model.telemetry.record(
+            start_time,
+            input_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens,
+            cost=self.model.cost(usage) * self.PRICE_FACTOR
+        )
+
+    def _merge(self, state: Dict[str, Any], total: int) -> List[Optional[str]]:
+        outputs: Dict[str, Optional[str]] = {}
+        for chunk in state["chunks"]:
+            with open(self._chunk_path("results", chunk)) as f:
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        outputs[item["custom_id"]] = item["output"]
+        return [outputs.get(self._custom_id(idx)) for idx in range(total)]
@@ -1,102 +1,169 @@
 import os
+import logging
 import anthropic
-import time
+from typing import Any, Dict, List, Optional, Union
 
 from models.base import BaseAPI
+from utils.rate_limit import RateLimiter
+from utils.cache import InferenceCache
+from utils.telemetry import Telemetry
+
+logger = logging.getLogger(__name__)
 
 class ClaudeAPI(BaseAPI):
     INPUT_COST = 0.000003
     OUTPUT_COST = 0.000015
-    
-    def __init__(self, model_name: str, prompt_type: str, api_key: str = None, tool: str = None):
-        super().__init__(model_name, prompt_type, tool)
+    # Prompt cache writes are billed 25% above input tokens, reads at 10%
+    CACHE_WRITE_COST = 0.00000375
+    CACHE_READ_COST = 0.0000003
+    # Output ceiling of the model, caps the budget of packed requests
+    MAX_OUTPUT_TOKENS = 8192
+
+    def __init__(
+        self,
+        model_name: str,
+        prompt_type: str,
+        api_key: str = None,
+        tool: str = None,
+        base_url: Optional[str] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[InferenceCache] = None,
+        telemetry: Optional[Telemetry] = None,
+        hedge_after: Optional[Union[float, str]] = None,
+        prompt_caching: bool = True,
+        stream: bool = False,
+        max_tokens: Optional[int] = None
+    ):
+        """
+        The prompt is sent as the system block. With `prompt_caching` it is
+        marked as a cache breakpoint, so requests after the first read it from
+        the prompt cache at a tenth of the input price. The API only caches
+        prefixes of at least 1024 tokens; shorter prompts are billed as usual.
+
+        With `stream`, Classifier answers are streamed and the connection is
+        closed as soon as a line states the label, instead of waiting for the
+        rest of the message.
+        """
+        super().__init__(
+            model_name, prompt_type, tool,
+            rate_limiter=rate_limiter, cache=cache, telemetry=telemetry, hedge_after=hedge_after,
+            max_tokens=max_tokens
+        )
         self.api_key = api_key or os.getenv("ANTROPHIC_KEY")
         if not self.api_key:
             raise ValueError("API key must be provided or set in the environment variable ANTHROPIC_KEY.")        
-        self.client = anthropic.Anthropic(api_key=self.api_key)
-        
+        # Retries are handled by BaseAPI so concurrent workers back off together
+        self.client = anthropic.Anthropic(api_key=self.api_key, base_url=base_url, max_retries=0)
+        self.prompt_caching = prompt_caching
+        self.stream = stream
+
         self.last_message = None
         self.total_cost = 0.0
 
-    def run_inference(self, image, max_retries=3, timeout=15):
-        if not hasattr(image, 'get_type') or not hasattr(image, 'get_base64'):
-            raise TypeError("Image must have get_type() and get_base64() methods.")
-
-
-        try:
-            start_time = time.time()
-            message = self.client.messages.create(
-                model=self.model_name,
-                max_tokens=1024,
-                # tools=self.tool,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": image.get_type(),
-                                    "data": image.get_base64(),
-                                },
-                            },
-                            {
-                                "type": "text",
-                                "text": self.prompt
-                            }
-                        ]
-                    }
-                ]
-            )
-            duration = time.time() - start_time
-            # if self.tool:
-            #     return self._clean_output(message.content[0].text)
-            if duration > timeout:
-                raise TimeoutError(f"Inference exceeded timeout ({timeout}s).")
-            self.last_message = message
-            return self._clean_output(message.content[0].text)
-
-        except Exception as e:
-            if max_retries > 0:
-                print(f"Inference failed with error: {e}. Retrying... ({max_retries} retries left)")
-                return self.run_inference(image, max_retries=max_retries - 1, timeout=timeout)
-            print(f"All inference attempts failed for image -> {image.get_path()}")
-            return None
+    def build_request(self, image) -> Dict[str, Any]:
+        """Builds the `messages.create` parameters for one image, shared by direct and batch calls."""
+        return self._build_params([self._image_block(image)], self.max_tokens)
+
+    def build_pages_request(self, images: List[Any]) -> Dict[str, Any]:
+        """Builds the `messages.create` parameters for several images, each introduced by its page label."""
+        content = []
+        for number, image in enumerate(images, start=1):
+            content.append({"type": "text", "text": f"Page {number}"})
+            content.append(self._image_block(image))
+        # After the images, so the system prompt stays an identical cacheable prefix
+        content.append({"type": "text", "text": self.pages_instruction(len(images))})
+        # Pages answer in labeled text, not through the tool
+        return self._build_params(content, min(self.max_tokens * len(images), self.MAX_OUTPUT_TOKENS), use_tool=False)
+
+    def _build_params(self, content: List[Dict[str, Any]], max_tokens: int, use_tool: bool = True) -> Dict[str, Any]:
+        system = {"type": "text", "text": self.prompt}
+        if self.prompt_caching:
+            system["cache_control"] = {"type": "ephemeral"}
+        params = {
+            "model": self.model_name,
+            "max_tokens": max_tokens,
+            "system": [system],
+            "messages": [
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ]
+        }
+        if self.tool and use_tool:
+            params["tools"] = self.tool
+            # Forces the call, so the answer never comes back as free text
+            params["tool_choice"] = {"type": "tool", "name": self.tool[0]["name"]}
+        return params
+
+    @staticmethod
+    def _image_block(image) -> Dict[str, Any]:
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": image.get_type(),
+                "data": image.get_base64(),
+            },
+        }
+
+    def parse_message(self, message) -> str:
+        if self.tool:
+            for block in message.content:
+                if block.type == "tool_use":
+                    return self._tool_output(block.input)
+            logger.warning("No %s call in the answer, parsing its text instead", self.tool[0]["name"])
+        return self._clean_output(self._message_text(message))
+
+    @staticmethod
+    def _message_text(message) -> str:
+        return "".join(block.text for block in message.content if block.type == "text")
+
+    def _send(self, image, timeout):
+        if self.stream and self.prompt_type == "Classifier" and not self.tool:
+            return self._send_streaming(image, timeout)
+        # The client aborts the request once `timeout` expires and raises APITimeoutError
+        message = self.client.messages.create(**self.build_request(image), timeout=timeout)
+        self.last_message = message
+        return self.parse_message(message), message.usage
+
+    def _send_streaming(self, image, timeout):
+        text = ""
+        label = None
+        with self.client.messages.stream(**self.build_request(image), timeout=timeout) as stream:
+            for delta in stream.text_stream:
+                text += delta
+                label = self._early_label(text)
+                if label is not None:
+                    # Leaving the block closes the connection, the rest is never generated
+                    break
+            message = stream.current_message_snapshot
+        if label is not None:
+            # Output usage only arrives with the end of the message, count what was read
+            usage = message.usage.model_copy(update={"output_tokens": max(message.usage.output_tokens, len(text) // 4 + 1)})
+            message = message.model_copy(update={"usage": usage})
+        # calculate_cost reads the usage from here
+        self.last_message = message
+        return label or self._clean_output(text), message.usage
+
+    def _send_pages(self, images, timeout):
+        message = self.client.messages.create(**self.build_pages_request(images), timeout=timeout)
+        self.last_message = message
+        # Pages missing from the text, or an answer without text, are retried one by one by run_inference_pages
+        return self._split_pages(self._message_text(message), len(images)), message.usage
+
+    def cost(self, usage) -> float:
+        # Cached prompt tokens are reported apart from `input_tokens`
+        cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        return super().cost(usage) + cache_write * self.CACHE_WRITE_COST + cache_read * self.CACHE_READ_COST
 
     def calculate_cost(self):
         if self.last_message is None:
             return 0.0
-        input_tokens = self.last_message.usage.input_tokens
-        output_tokens = self.last_message.usage.output_tokens
-        current_cost = (input_tokens * self.INPUT_COST) + (output_tokens * self.OUTPUT_COST)
+        current_cost = self.cost(self.last_message.usage)
         self.total_cost += current_cost
         return current_cost
 
     def reset_cost(self):
         self.total_cost = 0.0
-
-    def _clean_output(self, raw_output):
-        if self.tool:
-            lines = raw_output.strip().split("\n")
-            # Check for "no candidate" or "candidate"
-            for line in lines:
-                line_stripped = line.strip().lower()
-                if line_stripped == "no candidate":
-                    return "No Candidate"
-            for line in lines:
-                line_stripped = line.strip().lower()
-                if line_stripped == "candidate":
-                    return "Candidate"
-
-        # Attempt to extract JSON array from raw_output
-        start_index = raw_output.find('[')
-        end_index = raw_output.rfind(']')
-
-        # If a valid JSON structure is found, return just the JSON portion
-        if start_index != -1 and end_index != -1 and end_index > start_index:
-            json_str = raw_output[start_index:end_index+1].strip()
-            return json_str
-
-        # If no JSON extraction was possible, return the raw output
-        return raw_output
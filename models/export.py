@@ -0,0 +1,244 @@
+import os
+import csv
+import time
+import argparse
+import torch
+from torch import nn
+
+from utils.utils import scan_images
+
+# Variants written by `export_all`, fp32 first so the others are compared against it
+VARIANTS = ("torchscript", "onnx", "onnx-int8-dynamic", "onnx-int8-static")
+
+
+class SegformerLogits(nn.Module):
+    """Exposes a Hugging Face SegFormer as a plain `pixel_values -> logits` module, the interface every backend shares."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).logits
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session behind the same call as the eager modules:
+    an (N, 3, H, W) float tensor in, a logits tensor out.
+    """
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, pixel_values):
+        outputs = self.session.run(None, {self.input_name: pixel_values.detach().cpu().float().numpy()})
+        return torch.from_numpy(outputs[0])
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+def load_runtime_model(path, device, threads=None):
+    """Loads an exported model: `.onnx` through ONNX Runtime (CPU), anything else as TorchScript."""
+    if path.endswith(".onnx"):
+        if device.type != "cpu":
+            print(f"ONNX model {path} runs on CPU, ignoring device {device}")
+        return OnnxModel(path, threads)
+    model = torch.jit.load(path, map_location=device)
+    model.eval()
+    return model
+
+
+def export_torchscript(model, example, path):
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example, check_trace=False)
+    traced.save(path)
+    return path
+
+
+def export_onnx(model, example, path, opset=17):
+    torch.onnx.export(
+        model,
+        (example,),
+        path,
+        input_names=["pixel_values"],
+        output_names=["logits"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=opset,
+        # The dynamo exporter needs onnxscript, the TorchScript one handles both models
+        dynamo=False
+    )
+    return path
+
+
+def quantize_dynamic_int8(src, dst):
+    """INT8 weights, activations quantized on the fly. Needs no calibration data."""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(src, dst, weight_type=QuantType.QInt8, per_channel=True)
+    return dst
+
+
+def quantize_static_int8(src, dst, calibration_batches):
+    """INT8 weights and activations, with activation ranges calibrated on `calibration_batches`."""
+    from onnxruntime.quantization import quantize_static, CalibrationDataReader, QuantFormat, QuantType
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter(calibration_batches)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {"pixel_values": batch.numpy()}
+
+    quantize_static(
+        src, dst, Reader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True
+    )
+    return dst
+
+
+def export_all(model, example, output_dir, name, calibration_batches=None):
+    """Writes every variant of `model` to `output_dir`. Returns {variant: path}."""
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.cpu().eval()
+    example = example.cpu()
+    paths = {
+        "torchscript": export_torchscript(model, example, os.path.join(output_dir, f"{name}.pt")),
+        "onnx": export_onnx(model, example, os.path.join(output_dir, f"{name}.onnx")),
+    }
+    paths["onnx-int8-dynamic"] = quantize_dynamic_int8(paths["onnx"], os.path.join(output_dir, f"{name}.int8-dynamic.onnx"))
+    if calibration_batches:
+        paths["onnx-int8-static"] = quantize_static_int8(
+            paths["onnx"], os.path.join(output_dir, f"{name}.int8-static.onnx"), calibration_batches
+        )
+    return paths
+
+
+def load_batches(folder, preprocess, batch_size=8, limit=64):
+    """First `limit` images of `folder` (sorted, so runs compare the same pages) as preprocessed batches."""
+    from PIL import Image
+
+    paths = sorted(scan_images(folder))[:limit]
+    tensors = [preprocess(Image.open(path).convert("RGB")) for path in paths]
+    return [torch.stack(tensors[i:i + batch_size]) for i in range(0, len(tensors), batch_size)]
+
+
+def rotation_agreement(reference, logits):
+    """Top-1 agreement with the fp32 predictions and mean absolute confidence change."""
+    ref_probs, probs = reference.softmax(dim=1), logits.softmax(dim=1)
+    ref_conf, ref_pred = ref_probs.max(dim=1)
+    conf, pred = probs.max(dim=1)
+    return {
+        "agreement": (ref_pred == pred).float().mean().item(),
+        "confidence_delta": (ref_conf - conf).abs().mean().item(),
+    }
+
+
+def corners_agreement(reference, logits):
+    """Mask IoU against the fp32 masks and mean corner distance (normalised units)."""
+    from utils.corners import masks_to_corners
+
+    ref_masks, masks = reference[:, 0] > 0, logits[:, 0] > 0
+    intersection = (ref_masks & masks).flatten(1).sum(dim=1).float()
+    union = (ref_masks | masks).flatten(1).sum(dim=1).float().clamp(min=1)
+    corner_error = (masks_to_corners(ref_masks) - masks_to_corners(masks)).norm(dim=2).mean(dim=1)
+    return {
+        "agreement": (intersection / union).mean().item(),
+        "corner_error": corner_error[~corner_error.isnan()].mean().item() if (~corner_error.isnan()).any() else float("nan"),
+    }
+
+
+def report(reference_model, variants, batches, compare, output_csv=None, threads=None):
+    """
+    Times the eager fp32 model and every exported variant on CPU over the
+    same batches and compares their outputs to fp32 with `compare`.
+    """
+    device = torch.device("cpu")
+    models = [("eager-fp32", reference_model.cpu().eval())]
+    models += [(variant, load_runtime_model(path, device, threads)) for variant, path in variants.items()]
+
+    rows, reference_outputs = [], None
+    images = sum(len(batch) for batch in batches)
+    for variant, model in models:
+        with torch.inference_mode():
+            # Warm-up run, excluded from the timing (graph optimisation, allocations)
+            model(batches[0])
+            start = time.perf_counter()
+            outputs = torch.cat([model(batch).float() for batch in batches])
+            elapsed = time.perf_counter() - start
+        if reference_outputs is None:
+            reference_outputs = outputs
+        row = {"variant": variant, "ms_per_image": elapsed / images * 1000}
+        row["speedup"] = rows[0]["ms_per_image"] / row["ms_per_image"] if rows else 1.0
+        row.update(compare(reference_outputs, outputs))
+        rows.append(row)
+        print("  ".join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}" for key, value in row.items()))
+
+    if output_csv:
+        fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+        with open(output_csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+def load_detector(detector, model_path, model_version="b0", image_size=224):
+    """The eager fp32 model and its preprocessing, for `detector` 'rotation' or 'corners'."""
+    device = torch.device("cpu")
+    if detector == "rotation":
+        from models.resnet_rot_detector import load_model, build_transform
+
+        return load_model(model_path, device), build_transform(image_size)
+
+    from transformers import AutoImageProcessor, SegformerForSemanticSegmentation
+
+    model = SegformerForSemanticSegmentation.from_pretrained(f"nvidia/mit-{model_version}", num_labels=1)
+    model.load_state_dict(torch.load(os.path.join(model_path, 'best_model.pth'), weights_only=True, map_location=device))
+    processor = AutoImageProcessor.from_pretrained(f"nvidia/mit-{model_version}")
+    return SegformerLogits(model).eval(), lambda image: processor(images=image, return_tensors="pt")["pixel_values"][0]
+
+
+def argparser():
+    parser = argparse.ArgumentParser(
+        description="Export the rotation or corner detector to TorchScript/ONNX, quantize it to INT8 and report accuracy vs speed"
+    )
+    parser.add_argument("--detector", default="rotation", type=str, help="'rotation' (ResNet) or 'corners' (SegFormer)")
+    parser.add_argument("--model", default='', type=str, help="Folder containing best_model.pth")
+    parser.add_argument("--model_version", default="b0", type=str)
+    parser.add_argument("--image_size", default=224, type=int, help="Input size of the rotation model")
+    parser.add_argument("--output_dir", default="exports", type=str)
+    parser.add_argument("--images", default='', type=str, help="Sample images for calibration and the report")
+    parser.add_argument("--sample_size", default=64, type=int)
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--threads", default=0, type=int, help="ONNX Runtime intra-op threads, 0 for all cores")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = argparser()
+    model, preprocess = load_detector(args.detector, args.model, args.model_version, args.image_size)
+
+    batches = load_batches(args.images, preprocess, args.batch_size, args.sample_size) if args.images else []
+    example = batches[0] if batches else torch.randn(1, 3, args.image_size, args.image_size)
+    paths = export_all(model, example, args.output_dir, args.detector, calibration_batches=batches)
+    for variant, path in paths.items():
+        print(f"{variant}: {path}")
+
+    if batches:
+        compare = rotation_agreement if args.detector == "rotation" else corners_agreement
+        report(model, paths, batches, compare, os.path.join(args.output_dir, f"{args.detector}_report.csv"), args.threads or None)
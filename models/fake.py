@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import uuid
+import random
+from types import SimpleNamespace
+from typing import Optional, Union
+
+from models.base import BaseAPI, InferenceCancelled, Usage
+from models.batch import BatchTransport
+from utils.rate_limit import RateLimiter
+from utils.cache import InferenceCache
+from utils.telemetry import Telemetry
+
+class FakeAPIError(Exception):
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+class FakeAPI(BaseAPI):
+    """
+    Local stand-in for a remote model. Sleeps for a configurable latency
+    instead of calling an API, so pipelines can be exercised offline.
+    A fraction of requests can fail with an overload error, and a fraction
+    `tail_rate` can stall for `tail_latency` seconds to mimic a slow tail.
+    """
+    def __init__(
+        self,
+        model_name: str = "fake",
+        prompt_type: str = "Classifier",
+        tool: str = None,
+        latency: float = 0.5,
+        jitter: float = 0.1,
+        error_rate: float = 0.0,
+        answer: str = "No Candidate",
+        tail_rate: float = 0.0,
+        tail_latency: float = 10.0,
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[InferenceCache] = None,
+        telemetry: Optional[Telemetry] = None,
+        hedge_after: Optional[Union[float, str]] = None,
+        max_tokens: Optional[int] = None
+    ):
+        super().__init__(
+            model_name, prompt_type, tool,
+            rate_limiter=rate_limiter, cache=cache, telemetry=telemetry, hedge_after=hedge_after,
+            max_tokens=max_tokens
+        )
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.answer = answer
+
+    def build_request(self, image):
+        return {
+            "model": self.model_name,
+            "media_type": image.get_type(),
+            "data": image.get_base64(),
+            "prompt": self.prompt,
+        }
+
+    def parse_message(self, message):
+        return message.content[0].text
+
+    def _send(self, image, timeout):
+        # Encode like a real backend would, so CPU cost is accounted for
+        payload = image.get_base64()
+        self._respond(timeout)
+        return self.answer, Usage(input_tokens=len(self.prompt) // 4 + len(payload) // 1000, output_tokens=3)
+
+    def _send_pages(self, images, timeout):
+        payload = sum(len(image.get_base64()) for image in images)
+        # One round trip for the whole pack
+        self._respond(timeout)
+        raw_output = "\n".join(f"Page {number}: {self.answer}" for number in range(1, len(images) + 1))
+        usage = Usage(input_tokens=len(self.prompt) // 4 + payload // 1000, output_tokens=5 * len(images))
+        return self._split_pages(raw_output, len(images)), usage
+
+    def _respond(self, timeout):
+        """Waits out the simulated latency and raises the simulated failures."""
+        latency = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        if random.random() < self.tail_rate:
+            latency = self.tail_latency
+        # Like a client timeout, give up after `timeout` seconds; cancel() interrupts the wait
+        if self._shutdown.wait(min(latency, timeout)):
+            raise InferenceCancelled("Request aborted")
+        if latency > timeout:
+            raise TimeoutError(f"Request timed out after {timeout}s")
+        if random.random() < self.error_rate:
+            raise FakeAPIError("Overloaded", status_code=529)
+
+
+class LocalBatchTransport(BatchTransport):
+    """
+    Fake batch server backed by a directory. Every batch ends `latency`
+    seconds after submission and answers each request with `answer`.
+    State lives on disk so resumed runs can find earlier batches.
+    """
+    def __init__(self, root: str, latency: float = 1.0, answer: str = "No Candidate"):
+        self.root = root
+        self.latency = latency
+        self.answer = answer
+        os.makedirs(root, exist_ok=True)
+
+    def submit(self, requests):
+        batch_id = f"fakebatch_{uuid.uuid4().hex}"
+        with open(os.path.join(self.root, batch_id + ".json"), "w") as f:
+            json.dump({"submitted_at": time.time(), "custom_ids": [r["custom_id"] for r in requests]}, f)
+        return batch_id
+
+    def _load(self, batch_id):
+        with open(os.path.join(self.root, batch_id + ".json")) as f:
+            return json.load(f)
+
+    def is_done(self, batch_id):
+        return time.time() - self._load(batch_id)["submitted_at"] >= self.latency
+
+    def results(self, batch_id):
+        for custom_id in self._load(batch_id)["custom_ids"]:
+            message = SimpleNamespace(
+                content=[SimpleNamespace(type="text", text=self.answer)],
+                usage=Usage(input_tokens=0, output_tokens=3)
+            )
+            yield custom_id, message
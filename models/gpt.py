@@ -1,30 +1,99 @@
 import os
+import json
+import logging
 import openai
+from typing import Any, Dict, Optional, Union
 
-from models.base import BaseAPI
+from models.base import BaseAPI, Usage
+from utils.rate_limit import RateLimiter
+from utils.cache import InferenceCache
+from utils.telemetry import Telemetry
+
+logger = logging.getLogger(__name__)
 
 class OpenAIAPI(BaseAPI):
-    def __init__(self, model_name: str, prompt_type: str):
-        super().__init__(model_name, prompt_type)
-        client = openai.OpenAIApi(api_key=os.getenv("OPENAI_KEY"))
-
-    def run_inference(self, image_data: bytes):
-        # The OpenAI API's ChatCompletion doesn't directly handle images in messages.
-        # If you need image understanding, you'd typically use a vision model or a special endpoint.
-        # For the sake of structure, we'll just show prompt usage here.
-        
-        # If you wanted to combine image data, you'd need a model that accepts image inputs,
-        # or provide a description of the image encoded as text.
-        
-        # For demonstration, just use the prompt as text:
-        messages = [
-            {"role": "user", "content": self.prompt}
-        ]
-
-        response = openai.ChatCompletion.create(
-            model=self.model_name,
-            messages=messages,
-            max_tokens=1024
+    INPUT_COST = 0.0000025
+    OUTPUT_COST = 0.00001
+
+    def __init__(
+        self,
+        model_name: str,
+        prompt_type: str,
+        api_key: str = None,
+        tool: str = None,
+        base_url: Optional[str] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[InferenceCache] = None,
+        telemetry: Optional[Telemetry] = None,
+        hedge_after: Optional[Union[float, str]] = None,
+        max_tokens: Optional[int] = None
+    ):
+        super().__init__(
+            model_name, prompt_type, tool,
+            rate_limiter=rate_limiter, cache=cache, telemetry=telemetry, hedge_after=hedge_after,
+            max_tokens=max_tokens
         )
+        self.api_key = api_key or os.getenv("OPENAI_KEY")
+        if not self.api_key:
+            raise ValueError("API key must be provided or set in the environment variable OPENAI_KEY.")
+        # Retries are handled by BaseAPI so concurrent workers back off together
+        self.client = openai.OpenAI(api_key=self.api_key, base_url=base_url, max_retries=0)
+
+        self.last_message = None
+
+    def build_request(self, image) -> Dict[str, Any]:
+        """Builds the `chat.completions.create` parameters for one image, with the same payload as ClaudeAPI."""
+        params = {
+            "model": self.model_name,
+            "max_tokens": self.max_tokens,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{image.get_type()};base64,{image.get_base64()}"
+                            },
+                        },
+                        {
+                            "type": "text",
+                            "text": self.prompt
+                        }
+                    ]
+                }
+            ]
+        }
+        if self.tool:
+            # Same tool definitions as ClaudeAPI, in the function calling format
+            params["tools"] = [
+                {
+                    "type": "function",
+                    "function": {
+                        "name": tool["name"],
+                        "description": tool["description"],
+                        "parameters": tool["input_schema"],
+                    },
+                } for tool in self.tool
+            ]
+            params["tool_choice"] = {"type": "function", "function": {"name": self.tool[0]["name"]}}
+        return params
+
+    def parse_message(self, message) -> str:
+        reply = message.choices[0].message
+        if self.tool:
+            for call in reply.tool_calls or []:
+                try:
+                    return self._tool_output(json.loads(call.function.arguments))
+                except json.JSONDecodeError as e:
+                    logger.warning("Invalid %s arguments: %s", call.function.name, e)
+                    return self._clean_output(call.function.arguments)
+            logger.warning("No %s call in the answer, parsing its text instead", self.tool[0]["name"])
+        return self._clean_output(reply.content or "")
 
-        return response.choices[0].message['content'].strip()
+    def _send(self, image, timeout):
+        # The client aborts the request once `timeout` expires and raises APITimeoutError
+        message = self.client.chat.completions.create(**self.build_request(image), timeout=timeout)
+        self.last_message = message
+        usage = Usage(input_tokens=message.usage.prompt_tokens, output_tokens=message.usage.completion_tokens)
+        return self.parse_message(message), usage
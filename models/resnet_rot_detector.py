@@ -1,8 +1,21 @@
+import os
+import re
+import json
+import argparse
 import torch
 from tqdm import tqdm
 import torch.nn.functional as F
 import torch.nn as nn
 import torchvision
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader, Sampler
+from PIL import Image
+
+from utils.batching import collate, get_device
+from utils.utils import scan_images, chunked
+
+# Written next to best_model.pth at training time: {class label: class index}, as in ImageFolder.class_to_idx
+CLASS_TO_IDX_FILE = "class_to_idx.json"
 
 
 class ResNet(nn.Module):
@@ -18,26 +31,214 @@ class ResNet(nn.Module):
     def forward(self, x):
         return self.resnet50(x)
 
+
+def build_transform(image_size=224):
+    return transforms.Compose([
+        transforms.Resize((image_size, image_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+
+
+class FolderSampler(Sampler):
+    """
+    Streams the image paths of a folder as DataLoader indices. The folder is
+    scanned once, lazily, in the main process, and the DataLoader hands the
+    paths out to its workers a few batches ahead, so no file list is held in
+    memory and no image is read twice.
+    """
+    def __init__(self, folder, recursive=False):
+        self.folder = folder
+        self.recursive = recursive
+
+    def __iter__(self):
+        return scan_images(self.folder, self.recursive)
+
+
+class RotationDataset(Dataset):
+    """Loads the image at each path drawn from a `FolderSampler` through `transform`."""
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __getitem__(self, path):
+        name = os.path.basename(path)
+        try:
+            pixel_values = self.transform(Image.open(path).convert("RGB"))
+        except Exception as e:
+            return {"file": name, "error": str(e)}
+        return {"file": name, "pixel_values": pixel_values}
+
+
 def predict(model, dataloader, device):
-    results = []
-    processed_names = set()  # Usar un conjunto para manejar nombres únicos procesados
-    with torch.no_grad():
-        for images, names in tqdm(dataloader,desc="Processing images"):
-            images = images.to(device)
-            outputs = model(images)
-            probabilities = F.softmax(outputs, dim=1)
+    """
+    Yields (name, prediction, confidence) per image. Predictions and
+    confidences of a batch come back to the host in one transfer.
+    """
+    with torch.inference_mode():
+        for batch in dataloader:
+            for item in batch["failed"]:
+                print(f'Image {item["file"]} failed. Error: {item["error"]}')
+            if batch["pixel_values"] is None:
+                continue
+
+            images = batch["pixel_values"].to(device, non_blocking=True)
+            with torch.autocast(device_type=device.type, enabled=device.type == "cuda"):
+                outputs = model(images)
+            probabilities = F.softmax(outputs.float(), dim=1)
             confidences, predictions = torch.max(probabilities, dim=1)
-            for name, prediction, confidence in zip(names, predictions.cpu().numpy(), confidences.cpu().numpy()):
-                
-                if name not in processed_names:  # Solo añadir si no es duplicado
-                    processed_names.add(name)
-                    results.append((name, prediction, confidence))
-                else:
-                    print(f"Duplicate image name found and skipped: {name}")
-    return results
+            results = torch.stack([predictions.float(), confidences], dim=1).cpu()
+            for name, (prediction, confidence) in zip(batch["files"], results.tolist()):
+                yield name, int(prediction), confidence
+
+
+def load_rotations(model_dir, rotations=None):
+    """
+    Clockwise rotation (degrees) the page needs for each class index of the
+    model. best_model.pth holds weights only, so the mapping comes from
+    `rotations` (degrees in class index order) or from the training labels
+    in `model_dir/class_to_idx.json`, whose labels must contain the degrees
+    (e.g. {"0": 0, "180": 1, "270": 2, "90": 3} for folders sorted by name).
+    """
+    if rotations is None:
+        path = os.path.join(model_dir or "", CLASS_TO_IDX_FILE)
+        if not os.path.isfile(path):
+            raise ValueError(
+                f"Unknown class index to rotation mapping: pass the rotations in class index order "
+                f"or save the training labels to {path}."
+            )
+        with open(path) as f:
+            class_to_idx = json.load(f)
+        rotations = [None] * len(class_to_idx)
+        for label, index in class_to_idx.items():
+            degrees = re.search(r"\d+", str(label))
+            if degrees is None:
+                raise ValueError(f"Label {label!r} in {path} does not name a rotation in degrees.")
+            rotations[index] = int(degrees.group())
+
+    rotations = tuple(int(r) for r in rotations)
+    if len(rotations) != 4 or sorted(rotations) != [0, 90, 180, 270]:
+        raise ValueError(f"Expected the 4 rotations 0, 90, 180 and 270 in class index order, got {rotations}.")
+    return rotations
+
+
+def load_model(model_path, device):
+    model = ResNet(weights=None)
+    model.load_state_dict(torch.load(os.path.join(model_path, 'best_model.pth'), weights_only=True, map_location=device))
+    model.to(device)
+    model.eval()
+    return model
+
+
+def run_rotation(
+    model_path,
+    images_folder,
+    database=None,
+    technique_used="ResNet50 rotation",
+    is_new_best=True,
+    recursive=False,
+    device="auto",
+    batch_size=32,
+    num_workers=4,
+    image_size=224,
+    flush_every=1000,
+    runtime_model=None,
+    threads=None,
+    rotations=None
+):
+    """
+    Predicts the rotation of every image in `images_folder` and writes the
+    results to `database` (a `utils.mongo.Mongo`) through `update_rotation_bulk`,
+    `flush_every` images at a time, so memory stays flat however large the
+    folder is. Without a database the results are only printed.
+    `runtime_model` is an exported model (see models/export.py) used instead
+    of the eager checkpoint in `model_path`. Class indices are turned into
+    degrees with `load_rotations`.
+    """
+    rotations = load_rotations(model_path or os.path.dirname(runtime_model or ""), rotations)
+    device = get_device(device)
+    if runtime_model:
+        from models.export import load_runtime_model
+        model = load_runtime_model(runtime_model, device, threads)
+    else:
+        model = load_model(model_path, device)
+    if device.type == "cuda":
+        # Every batch has the same input shape
+        torch.backends.cudnn.benchmark = True
+
+    loader = DataLoader(
+        RotationDataset(build_transform(image_size)),
+        batch_size=batch_size,
+        sampler=FolderSampler(images_folder, recursive=recursive),
+        num_workers=num_workers,
+        collate_fn=collate,
+        pin_memory=device.type == "cuda",
+        persistent_workers=num_workers > 0
+    )
+
+    written = 0
+    with tqdm(desc="Predicting rotations", unit="img") as progress:
+        for chunk in chunked(predict(model, loader, device), flush_every):
+            updates = [
+                {
+                    "filename": name,
+                    "new_rotation": rotations[prediction],
+                    "technique_used": technique_used,
+                    "confidence": confidence,
+                    "is_new_best": is_new_best
+                } for name, prediction, confidence in chunk
+            ]
+            if database is not None:
+                database.update_rotation_bulk(updates)
+            else:
+                for update in updates:
+                    print(update["filename"], update["new_rotation"], round(update["confidence"], 4))
+            written += len(updates)
+            progress.update(len(updates))
+    return written
+
+
+def argparser():
+    parser = argparse.ArgumentParser(
+        description="Predict page rotations and store them in the database"
+    )
+    parser.add_argument("--model", default='', type=str, help="Folder containing best_model.pth")
+    parser.add_argument("--source_dir", default='', type=str)
+    parser.add_argument("--recursive", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--device", default="auto", type=str, help="'auto', 'cuda', 'cuda:N' or 'cpu'")
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--num_workers", default=4, type=int, help="DataLoader processes decoding and preprocessing images")
+    parser.add_argument("--image_size", default=224, type=int)
+    parser.add_argument("--rotations", default='', type=str,
+                        help="Degrees per class index, e.g. '0,180,270,90'. Empty reads class_to_idx.json next to the model")
+    parser.add_argument("--runtime_model", default='', type=str, help="Exported .onnx or TorchScript .pt model to run instead of --model")
+    parser.add_argument("--threads", default=0, type=int, help="ONNX Runtime intra-op threads, 0 for all cores")
+    parser.add_argument("--flush_every", default=1000, type=int, help="Predictions per bulk write")
+    parser.add_argument("--technique_used", default="ResNet50 rotation", type=str)
+    parser.add_argument("--dry_run", action=argparse.BooleanOptionalAction, default=False,
+                        help="Print the predictions instead of writing them to the database")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    model = ResNet()
-    for param in model.parameters():
-        print(param.requires_grad)
\ No newline at end of file
+    args = argparser()
+
+    database = None
+    if not args.dry_run:
+        from utils.mongo import Mongo
+        database = Mongo(connection_uri=os.getenv("MONGO_URI"))
+
+    run_rotation(
+        model_path=args.model,
+        images_folder=args.source_dir,
+        database=database,
+        technique_used=args.technique_used,
+        recursive=args.recursive,
+        device=args.device,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        image_size=args.image_size,
+        flush_every=args.flush_every,
+        runtime_model=args.runtime_model or None,
+        threads=args.threads or None,
+        rotations=args.rotations.split(",") if args.rotations else None
+    )
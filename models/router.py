@@ -0,0 +1,220 @@
+import time
+import random
+import logging
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from models.base import BaseAPI, Usage
+from utils.rate_limit import Backoff, is_retryable, is_rate_limited, get_retry_after
+from utils.cache import InferenceCache
+from utils.telemetry import Telemetry
+
+logger = logging.getLogger(__name__)
+
+
+class NoProviderAvailable(Exception):
+    """Every provider is overloaded; reported as a 529 so BaseAPI backs off and retries."""
+    status_code = 529
+
+
+class RoutedUsage(NamedTuple):
+    input_tokens: int
+    output_tokens: int
+    provider: 'Provider'
+    # The backend's own usage object, which may carry more billed fields (e.g. prompt cache tokens)
+    raw: Any
+
+
+class Provider:
+    """
+    One backend behind the router with its concurrency limit and live
+    statistics: exponentially weighted latency of successful requests and
+    error rate, plus a cooldown after it reported being overloaded.
+    """
+    def __init__(self, backend: BaseAPI, max_in_flight: int = 8, smoothing: float = 0.2):
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got {max_in_flight}.")
+        self.backend = backend
+        self.name = f"{type(backend).__name__}:{backend.model_name}"
+        self.max_in_flight = max_in_flight
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.output_tokens = 100.0
+        self.cooldown_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.in_flight < self.max_in_flight and now >= self.cooldown_until
+
+    def record_success(self, latency: float, usage) -> None:
+        self.latency = latency if self.latency is None else (1 - self.smoothing) * self.latency + self.smoothing * latency
+        self.error_rate = (1 - self.smoothing) * self.error_rate
+        self.output_tokens = (1 - self.smoothing) * self.output_tokens + self.smoothing * usage.output_tokens
+
+    def record_error(self, cooldown: float = 0.0) -> None:
+        self.error_rate = (1 - self.smoothing) * self.error_rate + self.smoothing
+        if cooldown > 0:
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown)
+
+    def expected_cost(self, input_tokens: int) -> float:
+        return self.backend.cost(Usage(input_tokens, int(self.output_tokens)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "latency_s": self.latency,
+            "error_rate": self.error_rate,
+            "pages": self.backend.telemetry.pages,
+        }
+
+
+class RouterAPI(BaseAPI):
+    """
+    Spreads requests over several backends. Each request goes to a provider
+    with a free slot, drawn with probability inversely proportional to its
+    score: a weighted sum of its latency, error rate and expected cost, each
+    relative to the best provider. Overloaded or failing providers are
+    skipped for the rest of the attempt and the request fails over to the
+    next one; when all of them fail, the usual BaseAPI retry applies.
+
+    Retries, rate limits and timeouts of the underlying backends are still
+    honoured, but their own retry loops are bypassed so failover is immediate.
+    """
+    def __init__(
+        self,
+        providers: List[Union[BaseAPI, Provider]],
+        prompt_type: Optional[str] = None,
+        latency_weight: float = 1.0,
+        error_weight: float = 2.0,
+        cost_weight: float = 0.5,
+        cooldown: float = 5.0,
+        cache: Optional[InferenceCache] = None,
+        telemetry: Optional[Telemetry] = None,
+        backoff: Optional[Backoff] = None
+    ):
+        if not providers:
+            raise ValueError("RouterAPI needs at least one provider.")
+        self.providers = [p if isinstance(p, Provider) else Provider(p) for p in providers]
+        first = self.providers[0].backend
+        super().__init__(
+            "router:" + ",".join(p.name for p in self.providers),
+            prompt_type or first.prompt_type,
+            None,
+            backoff=backoff,
+            cache=cache,
+            telemetry=telemetry
+        )
+        # Providers may run a different tool, the cache key follows the first one
+        self.tool = first.tool
+        self.latency_weight = latency_weight
+        self.error_weight = error_weight
+        self.cost_weight = cost_weight
+        self.cooldown = cooldown
+        self._available = threading.Condition()
+
+    def cost(self, usage) -> float:
+        if isinstance(usage, RoutedUsage):
+            return usage.provider.backend.cost(usage.raw)
+        return super().cost(usage)
+
+    def _send(self, image, timeout: float) -> Tuple[str, Any]:
+        input_tokens = self.estimate_input_tokens(image)
+        tried: List[Provider] = []
+        error: Optional[Exception] = None
+        while len(tried) < len(self.providers):
+            provider = self._acquire(input_tokens, tried)
+            if provider is None:
+                break
+            tried.append(provider)
+            try:
+                output, usage = self._send_to(provider, image, timeout)
+                return output, RoutedUsage(usage.input_tokens, usage.output_tokens, provider, usage)
+            except Exception as e:
+                error = e
+                if not is_retryable(e) or self._shutdown.is_set():
+                    raise
+                logger.warning("Provider %s failed: %s. Failing over", provider.name, e)
+        raise error or NoProviderAvailable("Every provider is cooling down")
+
+    def _send_to(self, provider: Provider, image, timeout: float) -> Tuple[str, Any]:
+        backend = provider.backend
+        start_time = backend.telemetry.start()
+        reserved = backend.rate_limiter.acquire() if backend.rate_limiter else 0
+        try:
+            output, usage = backend._send_hedged(image, timeout)
+        except Exception as e:
+            if backend.rate_limiter:
+                backend.rate_limiter.release(reserved)
+            cooldown = 0.0
+            if is_rate_limited(e):
+                cooldown = get_retry_after(e) or self.cooldown
+                if backend.rate_limiter:
+                    backend.rate_limiter.pause(cooldown)
+            backend.telemetry.record(start_time, bytes_uploaded=len(image.get_base64()), failed=True)
+            self._release(provider, lambda: provider.record_error(cooldown))
+            raise
+
+        if backend.rate_limiter:
+            backend.rate_limiter.record_usage(usage.input_tokens, usage.output_tokens, reserved)
+        backend.telemetry.record(
+            start_time,
+            input_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens,
+            bytes_uploaded=len(image.get_base64()),
+            cost=backend.cost(usage)
+        )
+        latency = time.perf_counter() - start_time
+        self._release(provider, lambda: provider.record_success(latency, usage))
+        return output, usage
+
+    def _acquire(self, input_tokens: int, exclude: List[Provider]) -> Optional[Provider]:
+        """Waits for a provider with a free slot and takes the slot. None if every candidate is cooling down."""
+        with self._available:
+            while not self._shutdown.is_set():
+                now = time.monotonic()
+                candidates = [p for p in self.providers if p not in exclude]
+                if not candidates:
+                    return None
+                free = [p for p in candidates if p.available(now)]
+                if free:
+                    provider = self._pick(free, input_tokens)
+                    provider.in_flight += 1
+                    return provider
+                if all(p.cooldown_until > now for p in candidates):
+                    # Everything left is overloaded, let BaseAPI back off instead of spinning here
+                    return None
+                self._available.wait(timeout=0.1)
+        return None
+
+    def _release(self, provider: Provider, update) -> None:
+        with self._available:
+            provider.in_flight -= 1
+            update()
+            self._available.notify()
+
+    def _pick(self, providers: List[Provider], input_tokens: int) -> Provider:
+        known = [p.latency for p in providers if p.latency is not None]
+        # Providers without samples are assumed as fast as the best one, so each gets tried
+        best_latency = min(known) if known else 1.0
+        costs = [p.expected_cost(input_tokens) for p in providers]
+        best_cost = min(costs)
+
+        weights = []
+        for provider, cost in zip(providers, costs):
+            latency = provider.latency if provider.latency is not None else best_latency
+            score = (
+                self.latency_weight * latency / max(best_latency, 1e-6)
+                + self.cost_weight * (cost / best_cost if best_cost > 0 else 1.0)
+                + self.error_weight * provider.error_rate
+            )
+            weights.append(1.0 / max(score, 1e-6))
+        return random.choices(providers, weights=weights)[0]
+
+    def _abort_requests(self) -> None:
+        for provider in self.providers:
+            provider.backend.cancel()
+
+    def provider_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._available:
+            return {p.name: p.stats() for p in self.providers}
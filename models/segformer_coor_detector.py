@@ -1,25 +1,34 @@
 import numpy as np
 import argparse
 import os
-import json
 import shutil
+from functools import partial
 import torch
-from torch import nn
 import torch.nn.functional as F
 import torchvision.models as models
 import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 import matplotlib.pyplot as plt  # For saving images
 
 from alive_progress import alive_bar
-from utils import get_coords
+from utils.batching import collate, get_device
+from utils.corners import masks_to_corners, corners_to_list
+from utils.jsonl import JsonlWriter, iter_jsonl
+from utils.utils import scan_images
+from models.export import SegformerLogits, load_runtime_model
 from transformers import AutoImageProcessor, SegformerForSemanticSegmentation
 
 
 PATH = os.getcwd()
+MASK_DIR = os.path.join(PATH, "debug_masks")
+BAD_INFERENCE_DIR = os.path.join(PATH, "bad_inferenceb0")
+# Aspect ratios are rounded to this step so masks of similar pages share an upsampling size
+ASPECT_BUCKET_STEP = 1 / 16
 
 def save_mask(image, mask, filename):
     """Save the original image and its segmentation mask as separate files."""
+    os.makedirs(MASK_DIR, exist_ok=True)
     img_save_path = os.path.join(MASK_DIR, f"{filename}_original.jpg")
     mask_save_path = os.path.join(MASK_DIR, f"{filename}_mask.png")
 
@@ -33,82 +42,147 @@ def save_mask(image, mask, filename):
     print(f"Saved debug images: {img_save_path}, {mask_save_path}")
 
 
-def inference(model_path, images_folder, output_file, iterations, save_debug_masks=True, model_version):
-    model = SegformerForSemanticSegmentation.from_pretrained(f"nvidia/mit-{model_version}", num_labels=1)
-    model.load_state_dict(torch.load(os.path.join(model_path, 'best_model.pth'), weights_only=True))
+class CornerDataset(Dataset):
+    """Decodes and preprocesses images inside DataLoader workers."""
+    def __init__(self, folder, files, processor):
+        self.folder = folder
+        self.files = files
+        self.processor = processor
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, idx):
+        file = self.files[idx]
+        try:
+            img = Image.open(os.path.join(self.folder, file)).convert("RGB")
+            pixel_values = self.processor(images=img, return_tensors="pt")["pixel_values"][0]
+        except Exception as e:
+            return {"file": file, "error": str(e)}
+        return {"file": file, "pixel_values": pixel_values, "size": img.size}
+
+
+def mask_size(size, max_side):
+    """Working mask size for an image: bucketed aspect ratio, longest side `max_side`."""
+    width, height = size
+    aspect = max(ASPECT_BUCKET_STEP, round((width / height) / ASPECT_BUCKET_STEP) * ASPECT_BUCKET_STEP)
+    if aspect >= 1:
+        return max(1, round(max_side / aspect)), max_side
+    return max_side, max(1, round(max_side * aspect))
+
+
+def upsample_masks(logits, sizes, max_side):
+    """
+    Thresholds at logit resolution (sigmoid > 0.5 <=> logit > 0) and upsamples
+    the binary masks to their working size, one interpolation per size bucket.
+    Yields (indices into the batch, (N, H, W) uint8 masks) per bucket.
+    """
+    low_res = (logits > 0).to(torch.uint8)
+    buckets = {}
+    for idx, size in enumerate(sizes):
+        buckets.setdefault(mask_size(size, max_side), []).append(idx)
+
+    for target, indices in buckets.items():
+        yield indices, F.interpolate(low_res[indices], size=target, mode="nearest").squeeze(1)
+
+
+def extract_corners(masks):
+    """8-value normalised corners per mask, or None where no page was found."""
+    corners = masks_to_corners(masks).cpu()
+    return [None if torch.isnan(c).any() else corners_to_list(c) for c in corners]
+
+
+def inference(
+    model_path,
+    images_folder,
+    output_file,
+    model_version,
+    save_debug_masks=False,
+    device="auto",
+    batch_size=8,
+    num_workers=4,
+    max_mask_side=1024,
+    resume=False,
+    checkpoint_every=500,
+    runtime_model=None,
+    threads=None
+):
+    """
+    Streams one {"filename", "corners"} record per image to `output_file + ".jsonl"`.
+    With `resume`, images already present in that file are skipped and new
+    records are appended. `runtime_model` is an exported .onnx or TorchScript
+    model (see models/export.py) used instead of the checkpoint in `model_path`.
+    """
+    device = get_device(device)
+    if runtime_model:
+        model = load_runtime_model(runtime_model, device, threads)
+    else:
+        segformer = SegformerForSemanticSegmentation.from_pretrained(f"nvidia/mit-{model_version}", num_labels=1)
+        segformer.load_state_dict(torch.load(os.path.join(model_path, 'best_model.pth'), weights_only=True, map_location=device))
+        model = SegformerLogits(segformer).to(device).eval()
 
     processor = AutoImageProcessor.from_pretrained(f"nvidia/mit-{model_version}")
 
-    device = "cuda"
-    model.to(device)
-    model.eval()
-
     path = os.path.join(PATH, images_folder)
-    files = os.listdir(path)
-
-    corners = []
+    # Names relative to `path`; subdirectories and non-image files are left out
+    files = [os.path.relpath(file, path) for file in scan_images(path)]
+
+    output_path = output_file + ".jsonl"
+    if resume and os.path.isfile(output_path):
+        done = {record["filename"] for record in iter_jsonl(output_path)}
+        files = [file for file in files if file not in done]
+        print(f"Resuming: {len(done)} images already processed, {len(files)} left")
+
+    loader = DataLoader(
+        CornerDataset(path, files, processor),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=partial(collate, fields=("file", "size")),
+        pin_memory=device.type == "cuda",
+        persistent_workers=num_workers > 0
+    )
 
-    # Optionally enable cuDNN benchmarking for consistent input sizes
-    torch.backends.cudnn.benchmark = True
+    if device.type == "cuda":
+        # Inputs are always resized to the same shape by the processor
+        torch.backends.cudnn.benchmark = True
 
-    with torch.no_grad():
+    with torch.inference_mode(), JsonlWriter(output_path, checkpoint_every, append=resume) as writer:
         with alive_bar(len(files)) as bar:
-            for file in files:
-                try:
-                    img_path = os.path.join(path, file)
-                    img = Image.open(img_path).convert("RGB")
-                    width, height = img.size  
-
-                    inputs = processor(images=img, return_tensors="pt").to(device)
-
-                    # Use mixed precision for faster inference
-                    with torch.cuda.amp.autocast():
-                        output = model(**inputs)
-                        logits = output.logits
-                        upsampled_logits = nn.functional.interpolate(
-                            logits,
-                            size=img.size[::-1],  # (height, width)
-                            mode='bilinear',
-                            align_corners=False
-                        )
-                        # Perform sigmoid and thresholding on GPU
-                        seg = (torch.sigmoid(upsampled_logits) > 0.5).to(torch.uint8)
-                    
-                    # Optionally save debug mask (convert to CPU only when needed)
-                    if save_debug_masks:
-                        seg_np = seg.cpu().squeeze().numpy()
-                        save_mask(img, seg_np, os.path.splitext(file)[0])
-                    
-                    # If get_coords can work with GPU tensors, pass seg directly
-                    seg_tensor = seg.squeeze()  # adjust dimensions as needed
-
-                    coords = get_coords(seg_tensor, iterations)
-                    if coords is None:
-                        print(f"get_coords returned None for image {file}. Skipping...")
-                        continue
-
-                    norm_factor = np.array([width, height], dtype=np.float32)
-                    coords = coords.astype(np.float32) / norm_factor
-
-                    coords_json = {
-                        "filename": file,
-                        "corners": [
-                            float(coords[1][0]), float(coords[1][1]),
-                            float(coords[0][0]), float(coords[0][1]),
-                            float(coords[3][0]), float(coords[3][1]),
-                            float(coords[2][0]), float(coords[2][1])
-                        ]
-                    }
-                    corners.append(coords_json)
-
-                except Exception as e:
-                    print(f'Image {file} failed. Error: {e}')
-                    shutil.copy(img_path, os.path.join(PATH, "bad_inferenceb0"))
-
-                bar()
-
-    with open(output_file + ".json", 'w') as f:
-        json.dump(corners, f, indent=4)
+            for batch in loader:
+                for item in batch["failed"]:
+                    print(f'Image {item["file"]} failed. Error: {item["error"]}')
+                    try:
+                        os.makedirs(BAD_INFERENCE_DIR, exist_ok=True)
+                        shutil.copy(os.path.join(path, item["file"]), BAD_INFERENCE_DIR)
+                    except OSError as e:
+                        print(f'Could not copy {item["file"]} to {BAD_INFERENCE_DIR}. Error: {e}')
+                    bar()
+                if batch["pixel_values"] is None:
+                    continue
+
+                pixel_values = batch["pixel_values"].to(device, non_blocking=True)
+                # Use mixed precision for faster inference on GPU
+                with torch.autocast(device_type=device.type, enabled=device.type == "cuda"):
+                    logits = model(pixel_values)
+                for indices, masks in upsample_masks(logits, batch["sizes"], max_mask_side):
+                    bucket_files = [batch["files"][idx] for idx in indices]
+                    try:
+                        results = extract_corners(masks)
+                    except Exception as e:
+                        print(f'Corner extraction failed for {bucket_files}. Error: {e}')
+                        results = [None] * len(bucket_files)
+
+                    for file, mask, result in zip(bucket_files, masks, results):
+                        # Optionally save debug mask (convert to CPU only when needed)
+                        if save_debug_masks:
+                            img = Image.open(os.path.join(path, file)).convert("RGB")
+                            save_mask(img.resize(mask.shape[::-1]), mask.cpu().numpy(), os.path.splitext(file)[0])
+
+                        if result is None:
+                            print(f"No corners found for image {file}. Skipping...")
+                        else:
+                            writer.write({"filename": file, "corners": result})
+                        bar()
 
 
 def argparser():
@@ -118,8 +192,17 @@ def argparser():
     parser.add_argument("--model", default='', type=str)
     parser.add_argument("--source_dir", default='', type=str)
     parser.add_argument("--output_dir", default='', type=str)
-    parser.add_argument('--iterations', default=1000, type=int)
-    paraser.add_argument("--model_version",default="b0",type=str)
+    parser.add_argument("--model_version",default="b0",type=str)
+    parser.add_argument("--device", default="auto", type=str, help="'auto', 'cuda', 'cuda:N' or 'cpu'")
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--num_workers", default=4, type=int, help="DataLoader processes decoding and preprocessing images")
+    parser.add_argument("--max_mask_side", default=1024, type=int, help="Longest side of the mask corners are extracted from")
+    parser.add_argument("--resume", action=argparse.BooleanOptionalAction, default=False,
+                        help="Skip images already written to the output .jsonl and append to it")
+    parser.add_argument("--checkpoint_every", default=500, type=int, help="Records between fsync'd checkpoints")
+    parser.add_argument("--runtime_model", default='', type=str, help="Exported .onnx or TorchScript .pt model to run instead of --model")
+    parser.add_argument("--threads", default=0, type=int, help="ONNX Runtime intra-op threads, 0 for all cores")
+    parser.add_argument("--save_debug_masks", action=argparse.BooleanOptionalAction, default=False)
 
     parser.add_argument(
         "--freeze", action=argparse.BooleanOptionalAction, default=False
@@ -132,13 +215,21 @@ def argparser():
 if __name__ == "__main__":
     args = argparser()
     world_size = torch.cuda.device_count()
-    
+
     print(f"Running on {world_size} GPUs")
-    
+
     inference(
         model_path=args.model,
         images_folder=args.source_dir,
         output_file=args.output_dir,
-        iterations=args.iterations,
-        model_version=args.model_version
+        model_version=args.model_version,
+        save_debug_masks=args.save_debug_masks,
+        device=args.device,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        max_mask_side=args.max_mask_side,
+        resume=args.resume,
+        checkpoint_every=args.checkpoint_every,
+        runtime_model=args.runtime_model or None,
+        threads=args.threads or None
     )
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+from PIL import Image
+
+from models.batch import BatchRunner
+from models.fake import FakeAPI, LocalBatchTransport
+
+
+class FlakyTransport(LocalBatchTransport):
+    """LocalBatchTransport that dies on submission number `fail_on` (1-based)."""
+    def __init__(self, root, fail_on=None, **kwargs):
+        super().__init__(root, **kwargs)
+        self.fail_on = fail_on
+        self.submitted = []
+
+    def submit(self, requests):
+        if len(self.submitted) + 1 == self.fail_on:
+            raise ConnectionError("Batch service went away")
+        batch_id = super().submit(requests)
+        self.submitted.append([request["custom_id"] for request in requests])
+        return batch_id
+
+
+@pytest.fixture
+def image_paths(tmp_path):
+    folder = tmp_path / "images"
+    folder.mkdir()
+    paths = []
+    for i in range(5):
+        path = folder / f"{i}.png"
+        Image.new("RGB", (16, 16), "white").save(path)
+        paths.append(str(path))
+    return paths
+
+
+def make_runner(work_dir, transport):
+    return BatchRunner(FakeAPI(), transport, str(work_dir), chunk_size=2, poll_interval=0.01)
+
+
+def test_run_resumes_after_a_failed_submit(image_paths, tmp_path):
+    work_dir, server = tmp_path / "work", str(tmp_path / "server")
+    first = FlakyTransport(server, fail_on=2, latency=0.0, answer="Candidate")
+
+    with pytest.raises(ConnectionError):
+        make_runner(work_dir, first).run(image_paths)
+    assert first.submitted == [["img-00000000", "img-00000001"]]
+
+    second = FlakyTransport(server, latency=0.0, answer="Candidate")
+    outputs = make_runner(work_dir, second).run(image_paths)
+
+    # The chunk submitted before the failure is picked up, not sent again
+    assert second.submitted == [["img-00000002", "img-00000003"], ["img-00000004"]]
+    assert outputs == ["Candidate"] * 5
+    with open(work_dir / "state.json") as f:
+        assert all(chunk["done"] for chunk in json.load(f)["chunks"])
+
+
+def test_finished_run_is_not_resubmitted(image_paths, tmp_path):
+    work_dir, server = tmp_path / "work", str(tmp_path / "server")
+    make_runner(work_dir, FlakyTransport(server, latency=0.0)).run(image_paths)
+
+    rerun = FlakyTransport(server, latency=0.0)
+    assert make_runner(work_dir, rerun).run(image_paths) == ["No Candidate"] * 5
+    assert rerun.submitted == []
+
+
+def test_state_of_other_inputs_is_rejected(image_paths, tmp_path):
+    work_dir, server = tmp_path / "work", str(tmp_path / "server")
+    make_runner(work_dir, FlakyTransport(server, latency=0.0)).run(image_paths)
+
+    with pytest.raises(ValueError, match="different set of inputs"):
+        make_runner(work_dir, FlakyTransport(server, latency=0.0)).run(image_paths[:3])
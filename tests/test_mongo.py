@@ -0,0 +1,80 @@
+"""
+update_corners_bulk against mongomock. Mongomock cannot run the
+detections_history update pipeline itself (see test_mongo_integration.py),
+so `bulk_write` is recorded and answered with the documents it matches.
+"""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from utils.mongo import Mongo
+
+CORNERS = [0.1, 0.1, 0.9, 0.1, 0.9, 0.9, 0.1, 0.9]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    db = Mongo("mongodb://localhost:27017")
+    db._client = mongomock.MongoClient()
+    db.collection.insert_many([{"blob_filename": f"{i}.jpg"} for i in range(4)])
+    db.writes = []
+
+    def bulk_write(requests, ordered=True):
+        db.writes.append(requests)
+        matched = sum(db.collection.count_documents(request._filter) for request in requests)
+        return SimpleNamespace(matched_count=matched, modified_count=matched)
+
+    monkeypatch.setattr(db.collection, "bulk_write", bulk_write)
+    return db
+
+
+def inferences():
+    return [
+        {"filename": "0.jpg", "corners": CORNERS},
+        {"filename": "1.jpg", "corners": CORNERS},
+        {"filename": "", "corners": CORNERS},
+        {"filename": "2.jpg", "corners": CORNERS},
+        {"filename": "missing.jpg", "corners": CORNERS},
+    ]
+
+
+def written_filenames(database):
+    return [[request._filter["blob_filename"] for request in requests] for requests in database.writes]
+
+
+def test_jsonl_is_written_in_chunks(database, tmp_path):
+    path = tmp_path / "corners.jsonl"
+    with open(path, "w") as f:
+        for item in inferences():
+            f.write(json.dumps(item) + "\n")
+        # Left by a run that died mid-write
+        f.write('{"filename": "3.jpg", "corn')
+
+    database.update_corners_bulk(str(path), chunk_size=2)
+
+    # One bulk_write per chunk of 2 records, records without a filename left out
+    assert written_filenames(database) == [["0.jpg", "1.jpg"], ["2.jpg"], ["missing.jpg"]]
+    assert database.writes[0][0] == database._update_corners_query(
+        {"blob_filename": "0.jpg"}, CORNERS, "SegFormerb5 versión febrero 2025", "v1", True
+    )
+
+
+def test_json_array_is_read_too(database, tmp_path):
+    path = tmp_path / "corners.json"
+    path.write_text(json.dumps(inferences()))
+
+    database.update_corners_bulk(str(path), chunk_size=1000)
+
+    assert written_filenames(database) == [["0.jpg", "1.jpg", "2.jpg", "missing.jpg"]]
+
+
+def test_empty_input_writes_nothing(database, tmp_path):
+    path = tmp_path / "corners.jsonl"
+    path.write_text("")
+
+    database.update_corners_bulk(str(path))
+
+    assert database.writes == []
@@ -0,0 +1,87 @@
+"""
+Runs the detections_history update pipeline against a real MongoDB (4.2+),
+which mongomock cannot execute. Skipped unless a server answers at
+MONGO_TEST_URI (default mongodb://localhost:27017). Only the throwaway
+database `ocr_integration_test` is written to, and dropped afterwards.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+
+from utils.mongo import Mongo
+
+TEST_URI = os.getenv("MONGO_TEST_URI", "mongodb://localhost:27017")
+TEST_DB = "ocr_integration_test"
+
+
+class ScratchMongo(Mongo):
+    @property
+    def collection(self):
+        return self.client[TEST_DB].files
+
+
+@pytest.fixture
+def database():
+    db = ScratchMongo(TEST_URI, server_selection_timeout_ms=1000, connect_timeout_ms=1000)
+    try:
+        version = db.client.server_info()["version"]
+    except Exception as e:
+        pytest.skip(f"No MongoDB server at {TEST_URI}: {e}")
+    if tuple(int(part) for part in version.split(".")[:2]) < (4, 2):
+        pytest.skip(f"Update pipelines need MongoDB 4.2+, server is {version}")
+    db.client.drop_database(TEST_DB)
+    yield db
+    db.client.drop_database(TEST_DB)
+    db.close()
+
+
+def rotation_update(filename, rotation, is_new_best=True):
+    return {
+        "filename": filename,
+        "new_rotation": rotation,
+        "technique_used": "test",
+        "confidence": 0.9,
+        "is_new_best": is_new_best,
+    }
+
+
+def test_versions_are_appended_and_best_follows_is_new_best(database):
+    database.collection.insert_one({"blob_filename": "a.jpg"})
+
+    database.update_rotation_bulk([rotation_update("a.jpg", 90)])
+    database.update_rotation_bulk([rotation_update("a.jpg", 180, is_new_best=False)])
+
+    document = database.collection.find_one({"blob_filename": "a.jpg"})
+    assert document["detections_history"]["v0"]["rotation"] == 90
+    assert document["detections_history"]["v1"]["rotation"] == 180
+    assert document["detections_counter"] == 1
+    assert document["best_metadata"]["rotation"] == "v0"
+    assert "_next_key" not in document
+
+
+def test_counter_is_seeded_from_existing_history(database):
+    database.collection.insert_one({
+        "blob_filename": "b.jpg",
+        "detections_history": {"v0": {"rotation": 0}, "v3": {"rotation": 270}},
+        "best_metadata": {"rotation": "v3"},
+    })
+
+    database.update_rotation_bulk([rotation_update("b.jpg", 90)])
+
+    document = database.collection.find_one({"blob_filename": "b.jpg"})
+    assert document["detections_history"]["v4"]["rotation"] == 90
+    assert document["best_metadata"]["rotation"] == "v4"
+
+
+def test_concurrent_writers_get_distinct_keys(database):
+    database.collection.insert_one({"blob_filename": "c.jpg"})
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda r: database.update_rotation_bulk([rotation_update("c.jpg", r % 4 * 90)]), range(32)))
+
+    document = database.collection.find_one({"blob_filename": "c.jpg"})
+    assert sorted(document["detections_history"]) == sorted(f"v{i}" for i in range(32))
+    assert document["detections_counter"] == 31
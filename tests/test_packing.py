@@ -0,0 +1,66 @@
+import pytest
+from PIL import Image
+
+from models.base import Usage
+from models.fake import FakeAPI
+from utils.image import Image_
+
+
+@pytest.mark.parametrize("raw_output, count, expected", [
+    ("Page 1: No Candidate\nPage 2: Candidate", 2, ["No Candidate", "Candidate"]),
+    ("**Page 1**\nCandidate\n\n**Page 2**\nNo Candidate", 2, ["Candidate", "No Candidate"]),
+    ("**Page 2**: Candidate", 2, [None, "Candidate"]),
+    ("Page 1 - Candidate\nPage 2 - No Candidate", 2, ["Candidate", "No Candidate"]),
+    ("## Page 1:\nCandidate\n## Page 2:\nNo Candidate", 2, ["Candidate", "No Candidate"]),
+    ("> page 1. \"No Candidate\"", 1, ["No Candidate"]),
+    # Out of order
+    ("Page 2: Candidate\nPage 1: No Candidate", 2, ["No Candidate", "Candidate"]),
+    # A repeated page keeps its first answer
+    ("Page 1: Candidate\nPage 1: No Candidate\nPage 2: No Candidate", 2, ["Candidate", "No Candidate"]),
+    # Out of range pages are ignored
+    ("Page 0: Candidate\nPage 3: Candidate\nPage 2: No Candidate", 2, [None, "No Candidate"]),
+    # "Page 10" is not page 1
+    ("Page 10: Candidate", 10, [None] * 9 + ["Candidate"]),
+    # Only headers at the start of a line count
+    ("Page 1: Candidate, unlike page 2\nPage 2: No Candidate", 2, ["Candidate, unlike page 2", "No Candidate"]),
+    # Missing or empty answers
+    ("Page 1: Candidate", 3, ["Candidate", None, None]),
+    ("Page 1:\nPage 2: Candidate", 2, [None, "Candidate"]),
+    ("Candidate\nNo Candidate", 2, [None, None]),
+    ("", 2, [None, None]),
+])
+def test_split_pages(raw_output, count, expected):
+    assert FakeAPI()._split_pages(raw_output, count) == expected
+
+
+class PartialPagesAPI(FakeAPI):
+    """Packed answers that skip page 2; single requests answer "Candidate"."""
+    def __init__(self, **kwargs):
+        super().__init__(latency=0.0, jitter=0.0, **kwargs)
+        self.packed = []
+        self.single = []
+
+    def _send_pages(self, images, timeout):
+        self.packed.append([image.get_path() for image in images])
+        raw_output = "\n".join(f"Page {n}: No Candidate" for n in range(1, len(images) + 1) if n != 2)
+        return self._split_pages(raw_output, len(images)), Usage(input_tokens=10, output_tokens=5)
+
+    def _send(self, image, timeout):
+        self.single.append(image.get_path())
+        return "Candidate", Usage(input_tokens=5, output_tokens=3)
+
+
+def test_unlabeled_pages_are_sent_on_their_own(tmp_path):
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / f"{i}.png")
+        Image.new("RGB", (16, 16), "white").save(path)
+        paths.append(path)
+    model = PartialPagesAPI()
+
+    answers = model.run_inference_pages([Image_(path=path) for path in paths])
+
+    assert answers == ["No Candidate", "Candidate", "No Candidate"]
+    assert model.packed == [paths]
+    assert model.single == [paths[1]]
+    assert model.telemetry.summary()["pages"] == 3
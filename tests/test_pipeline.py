@@ -0,0 +1,88 @@
+import csv
+import threading
+
+import pytest
+from PIL import Image
+
+from models.fake import FakeAPI, FakeAPIError
+from utils.pipeline import InferencePipeline
+
+
+class CountingFakeAPI(FakeAPI):
+    """FakeAPI that tracks how many requests are in flight and rejects the images named in `reject`."""
+    def __init__(self, reject=(), **kwargs):
+        super().__init__(**kwargs)
+        self.reject = set(reject)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self._counter = threading.Lock()
+
+    def _send(self, image, timeout):
+        with self._counter:
+            self.in_flight += 1
+            self.requests += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if image.get_path().endswith(tuple(self.reject)):
+                raise FakeAPIError("Bad request", status_code=400)
+            return super()._send(image, timeout)
+        finally:
+            with self._counter:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def image_paths(tmp_path):
+    folder = tmp_path / "images"
+    folder.mkdir()
+    paths = []
+    for i in range(24):
+        path = folder / f"{i:03d}.png"
+        Image.new("RGB", (32, 48), (i * 10, 255, 255)).save(path)
+        paths.append(str(path))
+    return paths
+
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_rows_are_rewritten_in_input_order(image_paths, tmp_path):
+    output_csv = str(tmp_path / "out.csv")
+    # Jitter makes requests finish out of order
+    model = CountingFakeAPI(latency=0.03, jitter=0.03)
+
+    InferencePipeline(model, output_csv, max_in_flight=6).run(image_paths)
+
+    rows = read_rows(output_csv)
+    assert [row["Index"] for row in rows] == [str(i) for i in range(len(image_paths))]
+    assert [row["Image"] for row in rows] == [path.rsplit("/", 1)[-1] for path in image_paths]
+    assert all(row["Answer"] == "No Candidate" and row["Source"] == "api" for row in rows)
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 4])
+def test_requests_in_flight_are_bounded(image_paths, tmp_path, max_in_flight):
+    model = CountingFakeAPI(latency=0.02, jitter=0.0)
+
+    InferencePipeline(model, str(tmp_path / "out.csv"), max_in_flight=max_in_flight).run(image_paths)
+
+    assert model.requests == len(image_paths)
+    assert model.max_in_flight == max_in_flight
+
+
+def test_failed_images_come_back_as_none(image_paths, tmp_path):
+    unreadable = tmp_path / "images" / "999.png"
+    unreadable.write_bytes(b"not an image")
+    paths = image_paths[:4] + [str(unreadable)]
+    output_csv = str(tmp_path / "out.csv")
+    model = CountingFakeAPI(reject=["001.png"], latency=0.01, jitter=0.0)
+
+    rows = InferencePipeline(model, output_csv, max_in_flight=2).run(paths)
+
+    answers = {row[2]: row[3] for row in rows}
+    assert answers == {"000.png": "No Candidate", "001.png": None, "002.png": "No Candidate",
+                       "003.png": "No Candidate", "999.png": None}
+    written = {row["Image"]: row["Answer"] for row in read_rows(output_csv)}
+    assert written["001.png"] == written["999.png"] == ""
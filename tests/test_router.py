@@ -0,0 +1,80 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from models.fake import FakeAPI
+from models.router import Provider, RouterAPI
+from utils.image import PreparedImage
+
+
+class TrackedFakeAPI(FakeAPI):
+    """FakeAPI that remembers the most requests it had in flight at once."""
+    def __init__(self, **kwargs):
+        super().__init__(jitter=0.0, **kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._counter = threading.Lock()
+
+    def _send(self, image, timeout):
+        with self._counter:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return super()._send(image, timeout)
+        finally:
+            with self._counter:
+                self.in_flight -= 1
+
+
+@pytest.fixture(autouse=True)
+def seeded():
+    # Provider choice and FakeAPI failures are random
+    random.seed(0)
+
+
+def image(i=0):
+    return PreparedImage(f"page_{i}.png", "image/png", "aGVsbG8=", tokens=100)
+
+
+def test_fails_over_when_a_provider_is_overloaded():
+    overloaded = TrackedFakeAPI(model_name="overloaded", latency=0.0, error_rate=1.0, answer="overloaded")
+    healthy = TrackedFakeAPI(model_name="healthy", latency=0.0, answer="healthy")
+    router = RouterAPI([overloaded, healthy], cooldown=60)
+
+    answers = [router.run_inference(image(i), max_retries=0) for i in range(20)]
+
+    assert answers == ["healthy"] * 20
+    # The 529 puts it in cooldown, so it is tried once and then skipped
+    assert overloaded.telemetry.failures == 1
+    assert healthy.telemetry.pages == 20
+    assert router.telemetry.failures == 0
+
+
+def test_per_provider_in_flight_caps_are_respected():
+    first = TrackedFakeAPI(model_name="first", latency=0.02)
+    second = TrackedFakeAPI(model_name="second", latency=0.02)
+    router = RouterAPI([Provider(first, max_in_flight=2), Provider(second, max_in_flight=3)])
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        answers = list(executor.map(lambda i: router.run_inference(image(i)), range(60)))
+
+    assert all(answer == "No Candidate" for answer in answers)
+    # Ten callers keep both providers full, never above their caps
+    assert (first.max_in_flight, second.max_in_flight) == (2, 3)
+    assert first.telemetry.pages + second.telemetry.pages == 60
+
+
+def test_traffic_shifts_to_the_faster_provider():
+    fast = TrackedFakeAPI(model_name="fast", latency=0.005)
+    slow = TrackedFakeAPI(model_name="slow", latency=0.1)
+    router = RouterAPI([fast, slow])
+
+    for i in range(60):
+        router.run_inference(image(i))
+
+    stats = router.provider_stats()
+    assert stats["TrackedFakeAPI:slow"]["pages"] >= 1
+    assert stats["TrackedFakeAPI:fast"]["pages"] > 4 * stats["TrackedFakeAPI:slow"]["pages"]
+    assert stats["TrackedFakeAPI:fast"]["latency_s"] < stats["TrackedFakeAPI:slow"]["latency_s"]
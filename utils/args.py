@@ -7,7 +7,19 @@ class Arguments:
         
         parser.add_argument(
             "--model", type=str, default="sonnet",
-            help="Model to use for inference. Options: 'sonnet', 'gpt'"
+            help="Model to use for inference. Options: 'sonnet', 'gpt', 'fake', 'router'"
+        )
+        parser.add_argument(
+            "--router_providers", type=str, default="sonnet,gpt",
+            help="Backends used by --model router, comma-separated 'model[:model_name[:max_in_flight]]'."
+        )
+        parser.add_argument(
+            "--model_name", type=str, default=None,
+            help="Exact model name sent to the API. Defaults to a sensible name for --model."
+        )
+        parser.add_argument(
+            "--api_base_url", type=str, default=None,
+            help="Override the API endpoint, e.g. a local stub server from utils/stub_server.py."
         )
         parser.add_argument(
             "--ground_truth_data", type=str,
@@ -19,6 +31,18 @@ class Arguments:
             default="/home/guillfa/CENIA/sources-traductor",
             help="Path to the sources traductor folder."
         )
+        parser.add_argument(
+            "--recursive", action="store_true",
+            help="Also scan subfolders of --sources_traductor for images."
+        )
+        parser.add_argument(
+            "--shard_count", type=int, default=1,
+            help="Split the images across this many independent runs by a hash of their path."
+        )
+        parser.add_argument(
+            "--shard_index", type=int, default=0,
+            help="Which shard (0 to --shard_count - 1) this run processes."
+        )
         parser.add_argument(
             "--output_csv", type=str, default="price_testing.csv",
             help="Path to the output CSV file."
@@ -27,5 +51,129 @@ class Arguments:
             "--prompt_type", type=str, default="Classifier",
             help="Prompt type for the model. Options: 'Classifier'."
         )
+        parser.add_argument(
+            "--tool", type=str, default=None,
+            help="Tool the model must answer through, parsed from its tool call. Options: 'extract_json'."
+        )
+        parser.add_argument(
+            "--max_tokens", type=int, default=0,
+            help="Output token budget per request. Use 0 for the budget of --prompt_type in utils/prompts.py."
+        )
+        parser.add_argument(
+            "--stream", action="store_true",
+            help="Stream Classifier answers from 'sonnet' and stop reading as soon as the label is decided."
+        )
+        parser.add_argument(
+            "--max_in_flight", type=int, default=16,
+            help="Maximum number of inference requests running concurrently. Use 1 for sequential runs."
+        )
+        parser.add_argument(
+            "--request_timeout", type=float, default=15,
+            help="Seconds before a single API request is aborted and retried."
+        )
+        parser.add_argument(
+            "--hedge_after", type=str, default="",
+            help="Send a duplicate of requests still pending after this many seconds, or 'p95' for the run's p95 latency. Empty disables hedging."
+        )
+        parser.add_argument(
+            "--pages_per_request", type=int, default=1,
+            help="Pack this many images into each request and parse a labeled answer per page. Supported by 'sonnet' and 'fake'; not used with --batch_dir."
+        )
+        parser.add_argument(
+            "--prompt_caching", action=argparse.BooleanOptionalAction, default=True,
+            help="Mark the prompt as a cache breakpoint on Claude requests, so repeated prompts are billed at the cached rate."
+        )
+        parser.add_argument(
+            "--preprocess_workers", type=int, default=0,
+            help="Processes that render and encode images ahead of the API workers. Use 0 to encode in the API threads."
+        )
+        parser.add_argument(
+            "--preprocess_queue_size", type=int, default=0,
+            help="Encoded images waiting for an API worker before scanning pauses. Use 0 for twice the worker count."
+        )
+        parser.add_argument(
+            "--requests_per_minute", type=float, default=0,
+            help="Requests per minute shared by all workers, e.g. your account tier's limit (50 on tier 1). 0 disables rate limiting and relies on backoff."
+        )
+        parser.add_argument(
+            "--tokens_per_minute", type=float, default=40000,
+            help="Input plus output tokens per minute shared by all workers, with --requests_per_minute."
+        )
+        parser.add_argument(
+            "--cache_path", type=str, default=".cache/inference.sqlite",
+            help="Path to the on-disk inference cache. Use an empty string to disable caching."
+        )
+        parser.add_argument(
+            "--cache_max_entries", type=int, default=100000,
+            help="Maximum number of cached results before least recently used entries are evicted."
+        )
+        parser.add_argument(
+            "--telemetry_path", type=str, default="logs/telemetry",
+            help="Prefix of the run summary files: <path>.json is overwritten, a row is appended to <path>.csv. Empty disables export."
+        )
+        parser.add_argument(
+            "--prefilter_threshold", type=float, default=0,
+            help="Answer Classifier pages locally when the layout prefilter is at least this confident (e.g. 0.9). Use 0 to send every page."
+        )
+        parser.add_argument(
+            "--rotate_crop", action="store_true",
+            help="Rotate and crop each image with its best metadata from the database before inference."
+        )
+        parser.add_argument(
+            "--prefetch_chunk_size", type=int, default=1000,
+            help="Number of images whose metadata is fetched per database query."
+        )
+        parser.add_argument(
+            "--mongo_ensure_indexes", action="store_true",
+            help="Create the database indexes the lookups rely on before running."
+        )
+        parser.add_argument(
+            "--mongo_query_check", type=str, default="warn",
+            help="Explain each database query shape once and report collection scans. Options: 'off', 'warn', 'fail'."
+        )
+        parser.add_argument(
+            "--mongo_max_pool_size", type=int, default=0,
+            help="Maximum database connections shared by all workers. Use 0 for --max_in_flight plus one."
+        )
+        parser.add_argument(
+            "--mongo_timeout_ms", type=int, default=10000,
+            help="Connect and server selection timeout for the database, in milliseconds."
+        )
+        parser.add_argument(
+            "--mongo_write_concern", type=str, default="",
+            help="Write concern 'w' for database updates, e.g. 'majority' or '1'. Empty keeps the server default."
+        )
+        parser.add_argument(
+            "--mongo_compressors", type=str, default="",
+            help="Comma-separated wire compressors, e.g. 'zstd,snappy,zlib'. Empty disables compression."
+        )
+        parser.add_argument(
+            "--encode_formats", type=str, default="",
+            help="Comma-separated formats the payload encoder may pick from, e.g. 'JPEG,WEBP'. Empty sends images in their source format, untouched."
+        )
+        parser.add_argument(
+            "--max_payload_bytes", type=int, default=500000,
+            help="Byte budget per encoded image, with --encode_formats."
+        )
+        parser.add_argument(
+            "--max_image_tokens", type=int, default=1600,
+            help="Input token budget per image with --encode_formats, images above it are downscaled."
+        )
+        parser.add_argument(
+            "--grayscale", type=str, default="auto",
+            help="Grayscale conversion of payloads. Options: 'auto', 'always', 'never'."
+        )
+        parser.add_argument(
+            "--batch_dir", type=str, default="",
+            help="Run through the batch API, keeping request files and progress in this folder. Rerun to resume."
+        )
+        parser.add_argument(
+            "--batch_chunk_size", type=int, default=100,
+            help="Number of images per submitted batch."
+        )
+        parser.add_argument(
+            "--batch_poll_interval", type=float, default=30.0,
+            help="Seconds between batch status checks."
+        )
 
         return parser.parse_args()
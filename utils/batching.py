@@ -0,0 +1,26 @@
+from typing import Any, Dict, List, Sequence
+
+import torch
+
+
+def get_device(device="auto"):
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def collate(items: List[Dict[str, Any]], fields: Sequence[str] = ("file",)) -> Dict[str, Any]:
+    """
+    DataLoader `collate_fn` for datasets that yield {"pixel_values", *fields}
+    or {"file", "error"} when an image could not be read. Returns the stacked
+    pixel values (None if every item failed), one list per field named in
+    plural ("file" -> "files") and the failed items.
+    """
+    ok = [item for item in items if "error" not in item]
+    batch = {
+        "pixel_values": torch.stack([item["pixel_values"] for item in ok]) if ok else None,
+        "failed": [item for item in items if "error" in item],
+    }
+    for field in fields:
+        batch[field + "s"] = [item[field] for item in ok]
+    return batch
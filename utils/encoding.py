@@ -0,0 +1,132 @@
+import math
+import logging
+from io import BytesIO
+from typing import Dict, NamedTuple, Optional, Sequence
+
+from PIL import Image, ImageChops, ImageStat
+
+logger = logging.getLogger(__name__)
+
+# Anthropic's estimate for image input tokens: width * height / 750
+PIXELS_PER_TOKEN = 750
+# Larger images are downscaled by the API before they are billed
+MAX_IMAGE_EDGE = 1568
+MAX_IMAGE_TOKENS = 1600
+
+
+def estimate_image_tokens(size) -> int:
+    """Input tokens billed for an image of `size`, after the API's own downscale."""
+    scale = min(1.0, MAX_IMAGE_EDGE / max(size))
+    return min(MAX_IMAGE_TOKENS, math.ceil(size[0] * scale * size[1] * scale / PIXELS_PER_TOKEN))
+
+
+class EncodedPayload(NamedTuple):
+    data: bytes
+    format: str
+    quality: int
+    grayscale: bool
+    size: tuple
+
+    @property
+    def media_type(self) -> str:
+        return f"image/{self.format.lower()}"
+
+    @property
+    def tokens(self) -> int:
+        return estimate_image_tokens(self.size)
+
+
+class PayloadEncoder:
+    """
+    Chooses format, quality and colour mode so each payload fits the byte and
+    token budget of its aspect-ratio bucket (see `Image_.TARGET_ASPECT_RATIOS`).
+    Budgets in `bucket_budgets` override the defaults per bucket.
+    """
+    def __init__(
+        self,
+        formats: Sequence[str] = ("JPEG", "WEBP"),
+        max_bytes: Optional[int] = 500_000,
+        max_tokens: Optional[int] = 1600,
+        grayscale: str = "auto",
+        min_quality: int = 40,
+        max_quality: int = 90,
+        bucket_budgets: Optional[Dict[str, Dict[str, int]]] = None
+    ):
+        if grayscale not in ("auto", "always", "never"):
+            raise ValueError(f"Invalid grayscale mode: {grayscale}. Options: 'auto', 'always', 'never'.")
+        self.formats = [f.upper() for f in formats]
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.grayscale = grayscale
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.bucket_budgets = bucket_budgets or {}
+
+    def budget(self, bucket: Optional[str]) -> Dict[str, Optional[int]]:
+        budget = {"max_bytes": self.max_bytes, "max_tokens": self.max_tokens}
+        budget.update(self.bucket_budgets.get(bucket, {}))
+        return budget
+
+    def fit_size(self, size, bucket: Optional[str] = None):
+        """Largest size with the same aspect ratio that stays within the bucket's token budget."""
+        max_tokens = self.budget(bucket)["max_tokens"]
+        # Pixel count, not `estimate_image_tokens`, which is capped at what the API bills
+        if max_tokens is None or size[0] * size[1] / PIXELS_PER_TOKEN <= max_tokens:
+            return size
+        scale = math.sqrt(max_tokens * PIXELS_PER_TOKEN / (size[0] * size[1]))
+        return max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+
+    def encode(self, image: Image.Image, bucket: Optional[str] = None) -> EncodedPayload:
+        max_bytes = self.budget(bucket)["max_bytes"]
+        grayscale = self._use_grayscale(image)
+        image = image.convert("L" if grayscale else "RGB")
+
+        while True:
+            best = None
+            for fmt in self.formats:
+                payload = self._search_quality(image, fmt, max_bytes, grayscale)
+                if best is None or (payload.quality, -len(payload.data)) > (best.quality, -len(best.data)):
+                    best = payload
+            if max_bytes is None or len(best.data) <= max_bytes or min(image.size) <= 64:
+                return best
+            # Still too large at the lowest quality, shrink and try again
+            scale = math.sqrt(max_bytes / len(best.data)) * 0.9
+            logger.debug("Payload of %d bytes over budget, downscaling by %.2f", len(best.data), scale)
+            image = image.resize((max(1, int(image.size[0] * scale)), max(1, int(image.size[1] * scale))), Image.BICUBIC)
+
+    def _search_quality(self, image: Image.Image, fmt: str, max_bytes: Optional[int], grayscale: bool) -> EncodedPayload:
+        """Binary search for the highest quality that fits in `max_bytes`."""
+        def save(quality):
+            buffer = BytesIO()
+            image.save(buffer, format=fmt, quality=quality, optimize=fmt == "JPEG")
+            return EncodedPayload(buffer.getvalue(), fmt, quality, grayscale, image.size)
+
+        best = save(self.max_quality)
+        if max_bytes is None or len(best.data) <= max_bytes:
+            return best
+
+        low, high = self.min_quality, self.max_quality - 1
+        best = None
+        while low <= high:
+            quality = (low + high) // 2
+            payload = save(quality)
+            if len(payload.data) <= max_bytes:
+                best, low = payload, quality + 1
+            else:
+                high = quality - 1
+        return best or save(self.min_quality)
+
+    def _use_grayscale(self, image: Image.Image) -> bool:
+        if self.grayscale != "auto":
+            return self.grayscale == "always"
+        if image.mode in ("L", "LA", "1"):
+            return True
+        sample = image.convert("RGB")
+        sample.thumbnail((64, 64))
+        red, green, blue = sample.split()
+        # Scanned text pages are usually colourless even when stored as RGB
+        spread = max(
+            ImageStat.Stat(ImageChops.difference(red, green)).mean[0],
+            ImageStat.Stat(ImageChops.difference(green, blue)).mean[0]
+        )
+        return spread < 4.0
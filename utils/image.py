@@ -1,13 +1,23 @@
 from PIL import Image
 import matplotlib.pyplot as plt
 import base64
+import copy
+import math
 from io import BytesIO
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Optional, Tuple
 import logging
 
+from utils.encoding import PayloadEncoder, estimate_image_tokens
+
 logger = logging.getLogger(__name__)
 
 class Image_:
+    """
+    Page image with a lazy transform pipeline. `rotate`, `crop` and
+    `resize_aspect_ratio` only record an affine transform; the source is
+    decoded once and resampled a single time when pixels or the encoded
+    payload are needed. Untouched files are sent with their original bytes.
+    """
     TARGET_ASPECT_RATIOS = {
         "1:1": (1092, 1092),
         "3:4": (951, 1268),
@@ -15,22 +25,73 @@ class Image_:
         "9:16": (819, 1456),
         "1:2": (784, 1568),
     }
+    # Formats the model APIs accept as-is
+    PASSTHROUGH_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
 
     def __init__(self, path: str):
         self.path: str = path
-        self.image: Image.Image = Image.open(path)
-        self.size: Tuple[int, int] = self.image.size
-        self.format: str = self.image.format
+        # Only the header is read here, pixels are decoded on demand
+        with Image.open(path) as image:
+            self.size: Tuple[int, int] = image.size
+            self.format: str = image.format
+        self._base: Optional[Image.Image] = None
+        self._base_size: Tuple[int, int] = self.size
+        self._matrix: Tuple[float, ...] = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+        self._transformed: bool = False
+        self._image: Optional[Image.Image] = None
+        self._payload: Optional[str] = None
+        self._media_type: Optional[str] = None
+        self._encoder: Optional[PayloadEncoder] = None
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            self._image = self._render()
+        return self._image
 
+    @image.setter
+    def image(self, image: Image.Image) -> None:
+        self._base = image
+        self._base_size = image.size
+        self.size = image.size
+        self._matrix = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+        self._transformed = False
+        self._image = image
+        self._payload = None
 
     def rotate(self, rotation: float) -> 'Image_':
         logger.debug("Rotating image %s by %f degrees", self.path, rotation)
-        self.image = self.image.rotate(-rotation, expand=True)
-        self.size = self.image.size
-        return self
+        # Same output geometry as PIL's `rotate(-rotation, expand=True)`
+        angle = (-rotation) % 360.0
+        if angle == 0:
+            return self
+        width, height = self.size
+        center_x, center_y = width / 2.0, height / 2.0
+        radians = -math.radians(angle)
+        matrix = [
+            round(math.cos(radians), 15), round(math.sin(radians), 15), 0.0,
+            round(-math.sin(radians), 15), round(math.cos(radians), 15), 0.0,
+        ]
+
+        def transform(x, y):
+            return matrix[0] * x + matrix[1] * y + matrix[2], matrix[3] * x + matrix[4] * y + matrix[5]
+
+        matrix[2], matrix[5] = transform(-center_x, -center_y)
+        matrix[2] += center_x
+        matrix[5] += center_y
+
+        xs, ys = zip(*(transform(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))))
+        new_width = math.ceil(max(xs)) - math.floor(min(xs))
+        new_height = math.ceil(max(ys)) - math.floor(min(ys))
+        matrix[2], matrix[5] = transform(-(new_width - width) / 2.0, -(new_height - height) / 2.0)
+
+        return self._apply(tuple(matrix), (new_width, new_height))
 
     def crop(self, corners: Dict[str, float]) -> 'Image_':
         logger.debug("Cropping image %s with corners: %s", self.path, corners)
+        if isinstance(corners, (list, tuple)):
+            # Flat [x1, y1, ..., x4, y4] list as written by the corner detector
+            corners = dict(zip(['x1', 'y1', 'x2', 'y2', 'x3', 'y3', 'x4', 'y4'], corners))
         width, height = self.size
         x1 = int(corners['x1'] * width)
         y1 = int(corners['y1'] * height)
@@ -46,12 +107,76 @@ class Image_:
         crop_xmax = max(x1, x2, x3, x4)
         crop_ymax = max(y1, y2, y3, y4)
 
-        self.image = self.image.crop((crop_xmin, crop_ymin, crop_xmax, crop_ymax))
-        self.size = self.image.size
+        return self._apply(
+            (1.0, 0.0, float(crop_xmin), 0.0, 1.0, float(crop_ymin)),
+            (crop_xmax - crop_xmin, crop_ymax - crop_ymin)
+        )
+
+    def resize(self, size: Tuple[int, int]) -> 'Image_':
+        logger.debug("Resizing image %s to %s", self.path, size)
+        if tuple(size) == tuple(self.size):
+            return self
+        width, height = self.size
+        return self._apply((width / size[0], 0.0, 0.0, 0.0, height / size[1], 0.0), tuple(size))
+
+    def _apply(self, matrix: Tuple[float, ...], size: Tuple[int, int]) -> 'Image_':
+        """Composes an output->input affine `matrix` onto the pending transform."""
+        a, b, c, d, e, f = self._matrix
+        ma, mb, mc, md, me, mf = matrix
+        self._matrix = (
+            a * ma + b * md, a * mb + b * me, a * mc + b * mf + c,
+            d * ma + e * md, d * mb + e * me, d * mc + e * mf + f,
+        )
+        self.size = size
+        self._transformed = True
+        self._image = None
+        self._payload = None
         return self
 
+    def _render(self) -> Image.Image:
+        """Decodes the source once and applies every pending transform in a single resample."""
+        image = self._base if self._base is not None else Image.open(self.path)
+        if not self._transformed:
+            image.load()
+            return image
+
+        a, b, c, d, e, f = self._matrix
+        # Source pixels per output pixel, used to shrink the source cheaply before resampling
+        scale = math.sqrt(abs(a * e - b * d))
+        if self._base is None and image.format == "JPEG" and scale >= 2:
+            image.draft(image.mode, (math.ceil(self._base_size[0] / scale), math.ceil(self._base_size[1] / scale)))
+        if image.mode in ("P", "1"):
+            # Palette and bilevel images can only be resampled with nearest neighbour
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        # Like `thumbnail` (reducing_gap=2), the cheap box reduce leaves at least 2x for the filtered resize
+        reduce = int(scale * image.size[0] / self._base_size[0] / 2)
+        if reduce >= 2:
+            image = image.reduce(reduce)
+
+        factor_x = image.size[0] / self._base_size[0]
+        factor_y = image.size[1] / self._base_size[1]
+        a, b, c, d, e, f = (a * factor_x, b * factor_x, c * factor_x, d * factor_y, e * factor_y, f * factor_y)
+        # `transform` does not antialias, so it only maps the geometry at (at least) source
+        # resolution and the remaining downscale goes through the filtered `resize`
+        width = max(self.size[0], math.ceil(round(self.size[0] * math.hypot(a, d), 6)))
+        height = max(self.size[1], math.ceil(round(self.size[1] * math.hypot(b, e), 6)))
+        step_x, step_y = self.size[0] / width, self.size[1] / height
+        matrix = (a * step_x, b * step_y, c, d * step_x, e * step_y, f)
+        image = image.transform((width, height), Image.AFFINE, matrix, resample=Image.BICUBIC)
+        if (width, height) != tuple(self.size):
+            image = image.resize(self.size, Image.BICUBIC)
+        return image
+
+    def thumbnail(self, max_side: int) -> Image.Image:
+        """Small rendering of the image with its pending transforms, leaving them untouched."""
+        scale = min(1.0, max_side / max(self.size))
+        preview = copy.copy(self)
+        preview.resize((max(1, round(self.size[0] * scale)), max(1, round(self.size[1] * scale))))
+        return preview._render()
+
     def save(self, output_path):
-        self.image.save(output_path)
+        image = self._image if self._image is not None else self._render()
+        image.save(output_path)
 
     def get_image(self):
         return self.image
@@ -63,15 +188,83 @@ class Image_:
         plt.imshow(self.image)
         plt.axis("off")
         plt.show()
-    
+
+    def prepare(self) -> 'PreparedImage':
+        """Renders and encodes the payload, returning a small picklable copy ready to send."""
+        return PreparedImage(self.path, self.get_type(), self.get_base64(), self.estimate_tokens())
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Rendered pixels are a cache, only the source and pending transform cross processes
+        state = self.__dict__.copy()
+        state["_image"] = None
+        return state
+
+    def set_encoder(self, encoder: Optional[PayloadEncoder]) -> 'Image_':
+        """Encodes the payload with `encoder` to fit its byte and token budget instead of the source format."""
+        self._encoder = encoder
+        self._payload = None
+        return self
+
+    def estimate_tokens(self) -> int:
+        """Input tokens the image is expected to cost once encoded."""
+        size = self.size
+        if self._encoder is not None:
+            size = self._encoder.fit_size(size, self._find_closest_aspect_ratio()[0])
+        return estimate_image_tokens(size)
+
     def get_type(self) -> str:
+        if self._encoder is not None:
+            # The media type is only known once the encoder picked a format
+            self.get_base64()
+            return self._media_type
         return f"image/{self.format.lower()}"
 
     def get_base64(self) -> str:
+        """Encoded payload, memoized until the next transform."""
+        if self._payload is None:
+            self._payload = base64.standard_b64encode(self._encode()).decode("utf-8")
+        return self._payload
+
+    def _encode(self) -> bytes:
+        bucket = None
+        if self._encoder is not None:
+            bucket = self._find_closest_aspect_ratio()[0]
+            self.resize(self._encoder.fit_size(self.size, bucket))
+
+        source = None
+        if self._base is None and not self._transformed and self.format in self.PASSTHROUGH_FORMATS:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            max_bytes = self._encoder.budget(bucket)["max_bytes"] if self._encoder is not None else None
+            if max_bytes is None or len(data) <= max_bytes:
+                if self._encoder is None:
+                    self._media_type = f"image/{self.format.lower()}"
+                    return data
+                # Fits the budget already, only re-encode if that makes it smaller
+                source = data
+
+        # Rendered pixels are not kept, so workers only hold the encoded payload
+        image = self._image if self._image is not None else self._render()
+        if self._encoder is not None:
+            payload = self._encoder.encode(image, bucket)
+            if source is not None and len(source) <= len(payload.data):
+                logger.debug(
+                    "Keeping the source bytes of %s: %d bytes, %s would take %d",
+                    self.path, len(source), payload.format, len(payload.data)
+                )
+                self._media_type = f"image/{self.format.lower()}"
+                return source
+            logger.debug(
+                "Encoded %s as %s q=%d gray=%s: %d bytes, ~%d tokens",
+                self.path, payload.format, payload.quality, payload.grayscale, len(payload.data), payload.tokens
+            )
+            self._media_type = payload.media_type
+            return payload.data
+
         buffer = BytesIO()
-        self.image.save(buffer, format=self.format)
-        buffer.seek(0)
-        return base64.standard_b64encode(buffer.read()).decode("utf-8")
+        image.save(buffer, format=self.format)
+        self._media_type = f"image/{self.format.lower()}"
+        return buffer.getvalue()
 
     def _calculate_aspect_ratio(self) -> float:
         return self.size[0] / self.size[1]
@@ -100,6 +293,53 @@ class Image_:
         _, target_dimensions = self._find_closest_aspect_ratio()
         target_width, target_height = target_dimensions
 
-        self.image.thumbnail((target_width, target_height))
-        self.size = self.image.size
-        return self
\ No newline at end of file
+        # Same output size as PIL's `thumbnail((target_width, target_height))`
+        width, height = self.size
+        if target_width >= width and target_height >= height:
+            return self
+        aspect = width / height
+        if target_width / target_height >= aspect:
+            new_width = max(min(math.floor(target_height * aspect), math.ceil(target_height * aspect),
+                                key=lambda n: abs(aspect - n / target_height)), 1)
+            new_height = target_height
+        else:
+            new_width = target_width
+            new_height = max(min(math.floor(target_width / aspect), math.ceil(target_width / aspect),
+                                 key=lambda n: 0 if n == 0 else abs(aspect - target_width / n)), 1)
+
+        return self._apply(
+            (width / new_width, 0.0, 0.0, 0.0, height / new_height, 0.0),
+            (new_width, new_height)
+        )
+
+
+class PreparedImage:
+    """
+    Encoded payload of an `Image_`, as returned by `Image_.prepare`. Exposes the
+    same accessors the model APIs use, so it can be sent in place of the image.
+    """
+    __slots__ = ("path", "media_type", "data", "tokens")
+
+    def __init__(self, path: str, media_type: str, data: str, tokens: int):
+        self.path = path
+        self.media_type = media_type
+        self.data = data
+        self.tokens = tokens
+
+    def __getstate__(self) -> Tuple[str, str, str, int]:
+        return self.path, self.media_type, self.data, self.tokens
+
+    def __setstate__(self, state: Tuple[str, str, str, int]) -> None:
+        self.path, self.media_type, self.data, self.tokens = state
+
+    def get_path(self) -> str:
+        return self.path
+
+    def get_type(self) -> str:
+        return self.media_type
+
+    def get_base64(self) -> str:
+        return self.data
+
+    def estimate_tokens(self) -> int:
+        return self.tokens
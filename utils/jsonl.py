@@ -0,0 +1,80 @@
+import os
+import json
+import logging
+from typing import Any, Dict, Iterator
+
+logger = logging.getLogger(__name__)
+
+def iter_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Yields one record per line. A truncated last line, left by a run that
+    died mid-write, is skipped with a warning.
+    """
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                if not line.endswith("\n"):
+                    logger.warning("Skipping truncated last line %d of %s", line_number, path)
+                    return
+                raise
+
+
+class JsonlWriter:
+    """
+    Appends records to a JSON Lines file. Data is flushed and fsync'd every
+    `checkpoint_every` records and on close, so a crash loses at most one
+    checkpoint interval.
+    """
+    def __init__(self, path: str, checkpoint_every: int = 1000, append: bool = False):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.count = 0
+        if append:
+            self._drop_partial_line()
+        self.file = open(path, "a" if append else "w")
+
+    def _drop_partial_line(self) -> None:
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            position = f.seek(0, os.SEEK_END)
+            if position == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            # Scan backwards for the last complete line instead of reading the whole file
+            while position > 0:
+                step = min(65536, position)
+                position -= step
+                f.seek(position)
+                newline = f.read(step).rfind(b"\n")
+                if newline != -1:
+                    f.truncate(position + newline + 1)
+                    return
+            f.truncate(0)
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self.file.write(json.dumps(record) + "\n")
+        self.count += 1
+        if self.count % self.checkpoint_every == 0:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+    def __enter__(self) -> 'JsonlWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -1,22 +1,159 @@
 import pymongo
 import logging
+import time
+import threading
 import json
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, Callable, Iterable, Iterator, List
 from pymongo import UpdateOne, MongoClient
+from pymongo.collection import Collection
 from bson.objectid import ObjectId
 
+from utils.utils import chunked
+from utils.jsonl import iter_jsonl
+
 logger = logging.getLogger(__name__)
 
+_NOT_PREFETCHED = object()
+
 class Mongo:
-    def __init__(self, connection_uri: str):
-        self.client = pymongo.MongoClient(connection_uri)
-        self.collection = self.client.data_repository.files
-        self._test_connection()
+    QUERY_CHECK_MODES = ("off", "warn", "fail")
+
+    def __init__(
+        self,
+        connection_uri: str,
+        query_check: str = "off",
+        max_pool_size: int = 100,
+        min_pool_size: int = 0,
+        connect_timeout_ms: int = 10000,
+        server_selection_timeout_ms: int = 10000,
+        socket_timeout_ms: Optional[int] = None,
+        write_concern: Optional[str] = None,
+        compressors: Optional[str] = None
+    ):
+        """
+        Nothing is opened here: the client is created and pinged on first use,
+        so runs that never query the database pay no connection cost. One
+        instance can be shared by every worker thread of a pipeline; they all
+        draw from a single pool of at most `max_pool_size` connections.
+        `write_concern` is the `w` option ("majority", "1", ...) and
+        `compressors` a comma-separated list such as "zstd,snappy,zlib".
+        """
+        if query_check not in self.QUERY_CHECK_MODES:
+            raise ValueError(f"Invalid query check mode: {query_check}. Options: {', '.join(self.QUERY_CHECK_MODES)}.")
+        self.connection_uri = connection_uri
+        self.client_options: Dict[str, Any] = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "connectTimeoutMS": connect_timeout_ms,
+            "serverSelectionTimeoutMS": server_selection_timeout_ms,
+            "socketTimeoutMS": socket_timeout_ms,
+        }
+        if write_concern:
+            self.client_options["w"] = int(write_concern) if write_concern.isdigit() else write_concern
+        if compressors:
+            self.client_options["compressors"] = compressors
+        self._client: Optional[MongoClient] = None
+        self._lock = threading.Lock()
+        # blob_filename -> resolved metadata (None if not found), filled by prefetch_metadata
+        self._metadata: Dict[str, Optional[Dict[str, Any]]] = {}
+        # With query_check != "off", each query shape is explained the first time it is issued
+        self.query_check = query_check
+        self._checked_queries: set = set()
+
+    @property
+    def client(self) -> MongoClient:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    client = pymongo.MongoClient(self.connection_uri, **self.client_options)
+                    self._test_connection(client)
+                    self._client = client
+        return self._client
+
+    @property
+    def collection(self) -> Collection:
+        return self.client.data_repository.files
+
+    def close(self) -> None:
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def ensure_indexes(self) -> None:
+        """Creates the indexes every lookup relies on. A no-op when they already exist."""
+        name = self.collection.create_index([("blob_filename", pymongo.ASCENDING)], name="blob_filename_1")
+        logger.info("Index '%s' is in place on %s", name, self.collection.full_name)
+
+    def _check_query_plan(self, query_name: str, explain: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Runs `explain` for `query_name` once and looks for collection scans in
+        the winning plan. Logs a warning or raises RuntimeError, depending on
+        `query_check`.
+        """
+        with self._lock:
+            if self.query_check == "off" or query_name in self._checked_queries:
+                return
+            self._checked_queries.add(query_name)
+        try:
+            plan = explain()
+        except pymongo.errors.PyMongoError as e:
+            logger.warning("Could not explain query '%s': %s", query_name, e)
+            return
+
+        if not self._has_collection_scan(plan):
+            logger.debug("Query '%s' uses an index", query_name)
+            return
+        message = (
+            f"Query '{query_name}' on {self.collection.full_name} does a collection scan (COLLSCAN). "
+            "Run Mongo.ensure_indexes() or pass --mongo_ensure_indexes."
+        )
+        if self.query_check == "fail":
+            raise RuntimeError(message)
+        logger.warning(message)
+
+    @classmethod
+    def _has_collection_scan(cls, plan: Any) -> bool:
+        """Whether any `winningPlan` in an explain output contains a COLLSCAN stage."""
+        def walk(node: Any, in_winning_plan: bool) -> bool:
+            if isinstance(node, dict):
+                if in_winning_plan and node.get("stage") == "COLLSCAN":
+                    return True
+                return any(
+                    walk(value, in_winning_plan or key == "winningPlan")
+                    for key, value in node.items()
+                    # Rejected plans are not executed
+                    if key != "rejectedPlans"
+                )
+            if isinstance(node, list):
+                return any(walk(value, in_winning_plan) for value in node)
+            return False
+
+        return walk(plan, False)
+
+    def _explain_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        return self.collection.database.command("explain", command, verbosity="queryPlanner")
+
+    def _check_update_plan(self, query_name: str, update: UpdateOne) -> None:
+        """Explains the first update of a bulk write; they all share the same filter shape."""
+        self._check_query_plan(query_name, lambda: self._explain_command({
+            "update": self.collection.name,
+            "updates": [{"q": update._filter, "u": update._doc, "multi": False}]
+        }))
 
     def extract_metadata(self, image_path: str) -> Optional[Dict[str, Any]]:
         logger.debug("Extracting metadata for image: %s", image_path)
         image_name = image_path.split('/')[-1]
-        document = self.client.data_repository.files.find_one({"blob_filename": image_name})
+        # Prefetched entries are consumed so the map stays bounded by one chunk
+        metadata = self._metadata.pop(image_name, _NOT_PREFETCHED)
+        if metadata is not _NOT_PREFETCHED:
+            if metadata is None:
+                logger.warning("Image '%s' not found in the database.", image_name)
+            return metadata
+
+        query = {"blob_filename": image_name}
+        self._check_query_plan("extract_metadata", lambda: self.collection.find(query).limit(1).explain())
+        document = self.collection.find_one(query)
         if not document:
             logger.warning("Image '%s' not found in the database.", image_name)
             return None
@@ -29,14 +166,70 @@ class Mongo:
 
         return {"rotation": rotation, "corners": corners}
 
+    def prefetch_metadata(self, image_paths: Iterable[str], chunk_size: int = 1000) -> int:
+        """
+        Loads the best rotation and corners of many images with one aggregation
+        per chunk, resolving `best_metadata` on the server so only two values
+        per document come back. Later `extract_metadata` calls for these images
+        are answered from memory. Returns the number of images found.
+        """
+        found = 0
+        for chunk in chunked((path.split('/')[-1] for path in image_paths), chunk_size):
+            start_time = time.time()
+            for image_name in chunk:
+                self._metadata[image_name] = None
+
+            pipeline = [
+                {"$match": {"blob_filename": {"$in": chunk}}},
+                {"$project": {
+                    "_id": 0,
+                    "blob_filename": 1,
+                    "rotation": self._best_detection("rotation"),
+                    "corners": self._best_detection("corners"),
+                }}
+            ]
+            self._check_query_plan("prefetch_metadata", lambda: self._explain_command({
+                "aggregate": self.collection.name, "pipeline": pipeline, "cursor": {}
+            }))
+            cursor = self.collection.aggregate(pipeline)
+            for document in cursor:
+                if document.get("rotation") is None or document.get("corners") is None:
+                    logger.warning("Image '%s' has no best rotation or corners.", document["blob_filename"])
+                    continue
+                self._metadata[document["blob_filename"]] = {
+                    "rotation": document["rotation"],
+                    "corners": document["corners"]
+                }
+                found += 1
+            logger.debug("Prefetched metadata for %d images in %.2fs", len(chunk), time.time() - start_time)
+        return found
+
+    @staticmethod
+    def _best_detection(field: str) -> Dict[str, Any]:
+        """Expression for `detections_history[best_metadata.<field>].<field>`."""
+        return {"$let": {
+            "vars": {"entry": {"$arrayElemAt": [
+                {"$filter": {
+                    "input": {"$objectToArray": {"$ifNull": ["$detections_history", {}]}},
+                    "cond": {"$eq": ["$$this.k", f"$best_metadata.{field}"]}
+                }},
+                0
+            ]}},
+            "in": f"$$entry.v.{field}"
+        }}
+
     def update_rotation_bulk(self, updates: List[Dict[str, Any]]) -> None:
+        """
+        Each update targets its document by `current_mongo_element["_id"]` or,
+        when no document was loaded beforehand, by `filename`.
+        """
         if not updates:
             logger.warning("No updates to perform.")
             return
         
         bulk_updates = [
             self._update_rotation_query(
-                update["current_mongo_element"],
+                self._rotation_filter(update),
                 update["new_rotation"],
                 update["technique_used"],
                 update["confidence"],
@@ -45,6 +238,7 @@ class Mongo:
         ]
 
         if bulk_updates:
+            self._check_update_plan("update_rotation_bulk", bulk_updates[0])
             try:
                 result = self.collection.bulk_write(bulk_updates, ordered=False)
                 logger.info("Bulk update completed: Matched: %d, Modified: %d", result.matched_count, result.modified_count)
@@ -52,80 +246,128 @@ class Mongo:
                 logger.exception("Bulk update failed: %s", e)
                 raise
 
-    def update_corners_bulk(self, json_path: str) -> None:
-        try:
-            with open(json_path) as f:
-                inferences_data = json.load(f)
-        except Exception as e:
-            logger.error("Failed to read JSON file: %s", e)
-            raise
-
-        bulk_updates = []
+    @staticmethod
+    def _rotation_filter(update: Dict[str, Any]) -> Dict[str, Any]:
+        if update.get("current_mongo_element") is not None:
+            return {"_id": ObjectId(update["current_mongo_element"]["_id"])}
+        return {"blob_filename": update["filename"]}
 
-        for item in inferences_data:
-            filename = item.get("filename")
-            corners = item.get("corners", [])
+    def update_corners_bulk(self, json_path: str, chunk_size: int = 1000) -> None:
+        """
+        Applies corner inferences from a JSON Lines stream (or a legacy JSON
+        array) with one `bulk_write` per chunk, so memory stays flat. Version
+        keys are allocated on the server, so no lookup is needed first.
+        """
+        matched = modified = processed = 0
 
-            if not filename:
-                continue
+        for chunk_number, chunk in enumerate(chunked(self._iter_inferences(json_path), chunk_size), start=1):
+            start_time = time.time()
+            bulk_updates = [
+                self._update_corners_query(
+                    {"blob_filename": item["filename"]},
+                    item.get("corners", []),
+                    "SegFormerb5 versión febrero 2025",
+                    "v1",  # Hardcoded for now, can be improved later
+                    True  # is_new_best
+                ) for item in chunk if item.get("filename")
+            ]
 
-            document = self.collection.find_one({"blob_filename": filename})
+            chunk_matched = 0
+            if bulk_updates:
+                self._check_update_plan("update_corners_bulk", bulk_updates[0])
+                try:
+                    result = self.collection.bulk_write(bulk_updates, ordered=False)
+                    chunk_matched = result.matched_count
+                    matched += result.matched_count
+                    modified += result.modified_count
+                except pymongo.errors.PyMongoError as e:
+                    logger.exception("Bulk update failed: %s", e)
+                    raise
 
-            if document:
-                bulk_updates.append(
-                    self._update_corners_query(
-                        document,
-                        corners,
-                        "SegFormerb5 versión febrero 2025",
-                        "v1",  # Hardcoded for now, can be improved later
-                        True  # is_new_best
-                    )
-                )
+            processed += len(chunk)
+            logger.info(
+                "Chunk %d: %d records, %d matched, write %.2fs (%d processed)",
+                chunk_number, len(chunk), chunk_matched, time.time() - start_time, processed
+            )
 
-        if bulk_updates:
-            try:
-                result = self.collection.bulk_write(bulk_updates, ordered=False)
-                logger.info("Bulk update completed: Matched: %d, Modified: %d", result.matched_count, result.modified_count)
-            except pymongo.errors.PyMongoError as e:
-                logger.exception("Bulk update failed: %s", e)
-                raise
+        if matched or modified:
+            logger.info("Bulk update completed: Matched: %d, Modified: %d", matched, modified)
         else:
             logger.info("No updates to process.")
 
-    def _test_connection(self) -> None:
+    def _iter_inferences(self, json_path: str) -> Iterator[Dict[str, Any]]:
         try:
-            self.client.admin.command('ping')
+            if json_path.endswith(".jsonl"):
+                yield from iter_jsonl(json_path)
+            else:
+                with open(json_path) as f:
+                    yield from json.load(f)
+        except Exception as e:
+            logger.error("Failed to read JSON file: %s", e)
+            raise
+
+    @staticmethod
+    def _test_connection(client: MongoClient) -> None:
+        try:
+            client.admin.command('ping')
             logger.info("MongoDB connection successful.")
         except Exception as e:
             logger.exception("Connection to MongoDB failed: %s", e)
             raise
 
-    def _get_next_key(self, mongo_element: Dict[str, Any]) -> str:
-        if 'detections_history' not in mongo_element:
-            return 'v0'
-        existing_keys = [int(s.replace('v', '')) for s in mongo_element['detections_history'].keys()]
-        next_key = f'v{max(existing_keys) + 1}'
-        return next_key
+    @staticmethod
+    def _append_detection_pipeline(field: str, new_entry: Dict[str, Any], is_new_best: bool) -> List[Dict[str, Any]]:
+        """
+        Update pipeline that adds `new_entry` to `detections_history` under the
+        next `vN` key. The key comes from a per-document counter incremented
+        inside the update itself, so concurrent writers to the same document
+        always get distinct keys. Documents written before the counter existed
+        are seeded from their highest existing key (no history -> v0).
+        `best_metadata.<field>` points at the new key if `is_new_best` or unset.
+
+        Update pipelines need MongoDB 4.2 or later. mongomock does not run
+        them, so this is covered by tests/test_mongo_integration.py against a
+        real server.
+        """
+        existing_versions = {
+            "$map": {
+                "input": {"$objectToArray": {"$ifNull": ["$detections_history", {}]}},
+                "as": "entry",
+                "in": {"$toInt": {"$substrCP": ["$$entry.k", 1, {"$strLenCP": "$$entry.k"}]}}
+            }
+        }
+        return [
+            {"$set": {"detections_counter": {"$add": [
+                {"$ifNull": ["$detections_counter", {"$reduce": {
+                    "input": existing_versions,
+                    "initialValue": -1,
+                    "in": {"$max": ["$$value", "$$this"]}
+                }}]},
+                1
+            ]}}},
+            {"$set": {"_next_key": {"$concat": ["v", {"$toString": "$detections_counter"}]}}},
+            {"$set": {
+                "detections_history": {"$mergeObjects": [
+                    {"$ifNull": ["$detections_history", {}]},
+                    {"$arrayToObject": [[{"k": "$_next_key", "v": {"$literal": new_entry}}]]}
+                ]},
+                f"best_metadata.{field}": {"$cond": [
+                    {"$or": [is_new_best, {"$eq": [{"$ifNull": [f"$best_metadata.{field}", None]}, None]}]},
+                    "$_next_key",
+                    f"$best_metadata.{field}"
+                ]}
+            }},
+            {"$project": {"_next_key": 0}}
+        ]
 
     def _update_rotation_query(
         self,
-        current_mongo_element: Dict[str, Any],
+        element_filter: Dict[str, Any],
         new_rotation: float,
         technique_used: str,
         confidence: float,
         is_new_best: bool
     ) -> UpdateOne:
-
-        update_query = {}
-        element_id = current_mongo_element['_id']
-        next_key = self._get_next_key(current_mongo_element)
-
-        if 'rotation' not in current_mongo_element.get('best_metadata', {}):
-            is_new_best = True
-
-        if is_new_best:
-            update_query["best_metadata.rotation"] = next_key
-
         new_entry = {
             'rotation': new_rotation,
             'source': 'root_file',
@@ -133,34 +375,28 @@ class Mongo:
             'confidence': confidence,
             'usable_for_training': False
         }
-        update_query[f"detections_history.{next_key}"] = new_entry
 
-        return UpdateOne({"_id": ObjectId(element_id)}, {"$set": update_query})
+        return UpdateOne(
+            element_filter,
+            self._append_detection_pipeline("rotation", new_entry, is_new_best)
+        )
 
     def _update_corners_query(
         self,
-        current_mongo_element: Dict[str, Any],
+        element_filter: Dict[str, Any],
         new_corners: List[float],
         technique_used: str,
         rotation_used: str,
         is_new_best: bool
     ) -> UpdateOne:
-        update_query = {}
-        element_id = current_mongo_element['_id']
-        next_key = self._get_next_key(current_mongo_element)
-
-        if 'corners' not in current_mongo_element.get('best_metadata', {}):
-            is_new_best = True
-
-        if is_new_best:
-            update_query["best_metadata.corners"] = next_key
-
         new_entry = {
             'corners': new_corners,
             'source': f'root_file + rotate_{rotation_used}',
             'technique_used': technique_used,
             'usable_for_training': False
         }
-        update_query[f"detections_history.{next_key}"] = new_entry
 
-        return UpdateOne({"_id": ObjectId(element_id)}, {"$set": update_query})
+        return UpdateOne(
+            element_filter,
+            self._append_detection_pipeline("corners", new_entry, is_new_best)
+        )
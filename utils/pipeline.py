@@ -0,0 +1,222 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
+
+from utils.image import Image_, PreparedImage
+from utils.prefilter import PrefilterDecision
+from utils.utils import save_to_csv, chunked
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_image(image: Image_, prefilter=None):
+    """Process-pool stage: the prefilter's decision, or the encoded payload for the model."""
+    if prefilter is not None:
+        decision = prefilter(image)
+        if decision is not None:
+            return decision
+    return image.prepare()
+
+
+class InferencePipeline:
+    """
+    Runs `model.run_inference` over many images with a bounded number of
+    requests in flight. Rows are appended to the output CSV as they complete
+    and the file is rewritten in input order once the run finishes.
+
+    With `preprocess_workers` > 0, images are rendered and encoded in a
+    process pool instead of the API threads. `preprocess` still runs in the
+    submitting thread, where it only records lazy transforms, and the encoded
+    payloads reach the API threads through a queue of `queue_size` entries
+    that blocks the producer when the network side falls behind.
+
+    A `prefilter` (see utils/prefilter.py) can answer pages locally before
+    they reach the model; the "Source" column tells which stage answered.
+
+    With `pages_per_request` > 1, consecutive images are packed into one
+    request through `model.run_inference_pages`, and `max_in_flight` counts
+    requests rather than images.
+    """
+    HEADERS = ["Index", "Folder", "Image", "Answer", "Duration", "Source"]
+
+    def __init__(
+        self,
+        model,
+        output_csv: str,
+        max_in_flight: int = 16,
+        preprocess: Optional[Callable[[Image_], Image_]] = None,
+        preprocess_workers: int = 0,
+        queue_size: Optional[int] = None,
+        request_timeout: float = 15,
+        prefilter: Optional[Callable[[Image_], Optional[PrefilterDecision]]] = None,
+        pages_per_request: int = 1
+    ):
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got {max_in_flight}.")
+        if pages_per_request < 1:
+            raise ValueError(f"pages_per_request must be at least 1, got {pages_per_request}.")
+        self.model = model
+        self.output_csv = output_csv
+        self.max_in_flight = max_in_flight
+        self.preprocess = preprocess
+        self.preprocess_workers = preprocess_workers
+        self.request_timeout = request_timeout
+        self.prefilter = prefilter
+        self.pages_per_request = pages_per_request
+        # Enough encoded payloads to keep every API thread busy while the pool works ahead
+        self.queue_size = queue_size or 2 * max(max_in_flight, preprocess_workers)
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+
+    def run(self, file_paths: Iterable[str], progress=None) -> List[List[Any]]:
+        rows: List[List[Any]] = []
+        save_to_csv(self.output_csv, [], self.HEADERS, mode='w')
+
+        try:
+            if self.preprocess_workers > 0:
+                self._run_staged(file_paths, rows, progress)
+            else:
+                executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+                try:
+                    for pack in chunked(enumerate(file_paths), self.pages_per_request):
+                        # Blocks once max_in_flight requests are pending, so the input
+                        # iterable is consumed lazily instead of queued all at once
+                        self._slots.acquire()
+                        future = executor.submit(self._process_pack, [(idx, file_path, None, None) for idx, file_path in pack])
+                        future.add_done_callback(lambda f: self._on_done(f, rows, progress))
+                    executor.shutdown(wait=True)
+                except KeyboardInterrupt:
+                    # Also while joining: pending requests return right away once cancelled
+                    self.model.cancel()
+                    executor.shutdown(wait=False)
+                    raise
+        except KeyboardInterrupt:
+            logger.warning("Interrupted, keeping the %d results finished so far", len(rows))
+            raise
+        finally:
+            with self._lock:
+                rows.sort(key=lambda row: row[0])
+                save_to_csv(self.output_csv, rows, self.HEADERS, mode='w')
+        logger.info("Processed %d images, results saved to %s", len(rows), self.output_csv)
+        return rows
+
+    def _run_staged(self, file_paths: Iterable[str], rows: List[List[Any]], progress) -> None:
+        ready: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        # Spawned workers do not inherit the parent's threads and locks
+        context = multiprocessing.get_context("spawn")
+        processes = ProcessPoolExecutor(max_workers=self.preprocess_workers, mp_context=context)
+        threads = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        consumers = [threads.submit(self._consume, ready, rows, progress) for _ in range(self.max_in_flight)]
+        stopped = 0
+        try:
+            for pack in chunked(enumerate(file_paths), self.pages_per_request):
+                start_time = time.time()
+                # Blocks while the queue is full, which also caps the images being encoded
+                ready.put([
+                    (idx, file_path, self._submit_prepare(processes, file_path).result, start_time)
+                    for idx, file_path in pack
+                ])
+            for _ in consumers:
+                ready.put(None)
+                stopped += 1
+            for consumer in consumers:
+                consumer.result()
+            threads.shutdown(wait=True)
+            processes.shutdown(wait=True)
+        except KeyboardInterrupt:
+            # Also while joining: cancelled consumers drain the queue right away
+            self.model.cancel()
+            processes.shutdown(wait=False, cancel_futures=True)
+            for _ in range(len(consumers) - stopped):
+                ready.put(None)
+            threads.shutdown(wait=False)
+            raise
+
+    def _submit_prepare(self, processes: ProcessPoolExecutor, file_path: str) -> Future:
+        try:
+            image = self._load(file_path)
+            return processes.submit(prepare_image, image, self.prefilter)
+        except Exception as e:
+            future: Future = Future()
+            future.set_exception(e)
+            return future
+
+    def _consume(self, ready: queue.Queue, rows: List[List[Any]], progress) -> None:
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            self._save_rows(self._process_pack(item), rows, progress)
+
+    def _load(self, file_path: str) -> Image_:
+        image = Image_(path=file_path)
+        if self.preprocess is not None:
+            image = self.preprocess(image)
+        return image
+
+    def _process_pack(
+        self,
+        items: List[Tuple[int, str, Optional[Callable[[], Union[PreparedImage, PrefilterDecision]]], Optional[float]]]
+    ) -> List[List[Any]]:
+        """
+        Rows for `items` of (idx, file_path, load, start_time). Pages the
+        prefilter answers stay local, the rest go to the model together.
+        """
+        started = time.time()
+        answers = {}
+        pending = []
+        for idx, file_path, load, start_time in items:
+            logger.debug("Processing image: %s", os.path.basename(file_path))
+            try:
+                image = load() if load is not None else self._load(file_path)
+                if self.prefilter is not None and isinstance(image, Image_):
+                    image = self.prefilter(image) or image
+            except Exception as e:
+                logger.exception("Image %s failed: %s", os.path.basename(file_path), e)
+                image = None
+            if isinstance(image, PrefilterDecision):
+                answers[idx] = (image.label, "prefilter")
+            elif image is None:
+                answers[idx] = (None, "api")
+            else:
+                pending.append((idx, image))
+
+        if pending:
+            try:
+                outputs = self.model.run_inference_pages([image for _, image in pending], timeout=self.request_timeout)
+            except Exception as e:
+                logger.exception("Images %s failed: %s", ", ".join(image.get_path() for _, image in pending), e)
+                outputs = [None] * len(pending)
+            for (idx, _), output in zip(pending, outputs):
+                answers[idx] = (output, "api")
+
+        now = time.time()
+        return [
+            [
+                idx,
+                os.path.basename(os.path.dirname(file_path)),
+                os.path.basename(file_path),
+                answers[idx][0],
+                round(now - (start_time or started), 3),
+                answers[idx][1]
+            ] for idx, file_path, _, start_time in items
+        ]
+
+    def _on_done(self, future: Future, rows: List[List[Any]], progress) -> None:
+        try:
+            self._save_rows(future.result(), rows, progress)
+        finally:
+            self._slots.release()
+
+    def _save_rows(self, new_rows: List[List[Any]], rows: List[List[Any]], progress) -> None:
+        with self._lock:
+            rows.extend(new_rows)
+            save_to_csv(self.output_csv, new_rows, self.HEADERS)
+            if progress is not None:
+                progress.update(len(new_rows))
@@ -0,0 +1,96 @@
+import logging
+from typing import Any, Dict, NamedTuple, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class PrefilterDecision(NamedTuple):
+    label: str
+    confidence: float
+    reason: str
+
+
+class LayoutPrefilter:
+    """
+    Cheap first stage for the "Classifier" prompt. Projection profiles of a
+    small grayscale rendering tell apart the pages that cannot hold parallel
+    text: blank pages, full-page figures and single-column prose. Those are
+    answered "No Candidate" locally when the confidence reaches `threshold`;
+    every other page returns None and goes to the model.
+    """
+    LABEL = "No Candidate"
+
+    def __init__(self, threshold: float = 0.9, max_side: int = 512):
+        if not 0 < threshold <= 1:
+            raise ValueError(f"threshold must be in (0, 1], got {threshold}.")
+        self.threshold = threshold
+        self.max_side = max_side
+
+    def __call__(self, image) -> Optional[PrefilterDecision]:
+        try:
+            features = self.features(np.asarray(image.thumbnail(self.max_side).convert("L"), dtype=np.float32))
+        except Exception as e:
+            logger.warning("Prefilter could not analyse %s, sending it to the model: %s", image.get_path(), e)
+            return None
+
+        decision = self.decide(features)
+        if decision is None or decision.confidence < self.threshold:
+            return None
+        logger.debug("Prefilter: %s is %s (%s, %.2f)", image.get_path(), decision.label, decision.reason, decision.confidence)
+        return decision
+
+    @staticmethod
+    def features(gray: np.ndarray) -> Dict[str, Any]:
+        height, width = gray.shape
+        # Paper is the bright end of the histogram; ink is anything clearly darker
+        paper = np.percentile(gray, 95)
+        ink = gray < paper * 0.6
+        ink_ratio = float(ink.mean())
+        # Photos and drawings are dominated by mid tones, printed text is bimodal
+        midtones = float(((gray > paper * 0.25) & (gray < paper * 0.75)).mean())
+
+        # Text block: rows and columns that hold ink, ignoring a thin border of scan noise
+        column_profile = ink.mean(axis=0)
+        row_profile = ink.mean(axis=1)
+        columns = np.flatnonzero(column_profile > 0.01)
+        rows = np.flatnonzero(row_profile > 0.01)
+        if len(columns) == 0 or len(rows) == 0:
+            return {"ink_ratio": ink_ratio, "midtones": midtones, "text_columns": 0, "row_gap_ratio": 0.0}
+
+        # Gutters: runs of empty columns inside the text block, at least 2% of the page wide
+        body = column_profile[columns[0]:columns[-1] + 1] <= 0.002
+        min_gutter = max(2, int(0.02 * width))
+        gutters = sum(1 for run in _runs(body) if run >= min_gutter)
+
+        # Blank bands between lines; one band much taller than a line gap splits the page in blocks
+        gaps = [run for run in _runs(row_profile[rows[0]:rows[-1] + 1] <= 0.002) if run >= 1]
+        row_gap_ratio = max(gaps) / max(np.median(gaps), 1.0) if gaps else 0.0
+
+        return {
+            "ink_ratio": ink_ratio,
+            "midtones": midtones,
+            "text_columns": gutters + 1,
+            "row_gap_ratio": float(row_gap_ratio),
+            "lines": len(gaps) + 1,
+        }
+
+    def decide(self, features: Dict[str, Any]) -> Optional[PrefilterDecision]:
+        ink_ratio = features["ink_ratio"]
+        if ink_ratio < 0.002 or features["text_columns"] == 0:
+            return PrefilterDecision(self.LABEL, 0.99, "blank")
+        if features["midtones"] > 0.4:
+            return PrefilterDecision(self.LABEL, min(0.99, 0.5 + features["midtones"]), "figure")
+        if features["text_columns"] == 1 and features.get("lines", 0) >= 8:
+            # Evenly spaced lines in one column: prose. A tall gap may separate two languages stacked vertically
+            confidence = 0.97 - 0.05 * max(0.0, features["row_gap_ratio"] - 1.5)
+            return PrefilterDecision(self.LABEL, max(0.0, confidence), "single column")
+        return None
+
+
+def _runs(mask: np.ndarray):
+    """Lengths of the runs of True in a 1D boolean array."""
+    padded = np.concatenate([[False], mask, [False]]).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return (edges[1::2] - edges[0::2]).tolist()
@@ -31,8 +31,8 @@ Ignore any text that is not in Spanish or Rapanui, or that does not form part of
 
 **Important Instructions:**
 - You must not include any additional commentary, explanations, or text outside of the JSON.
-- Use the `print_pairs` tool exactly once to output your final answer.
-- The output must be a strictly valid JSON array following this structure:
+- Use the `print_pairs` tool exactly once to output your final answer, with the pairs in its `pairs` argument.
+- The pairs must be a strictly valid JSON array following this structure:
 
 [
   {
@@ -59,22 +59,38 @@ No other text is allowed outside the JSON. Do not explain or summarize. Your fin
 
 ## Tool structure obtained from 
 ## https://docs.anthropic.com/en/docs/build-with-claude/tool-use#json-mode
+## Tool inputs must be objects, so the array of pairs is wrapped in "pairs"
 tools = {
     "extract_json": [
         {
             "name": "print_pairs",
             "description": "Prints the extracted Rapa Nui-Spanish text pairs in a structured JSON format.",
             "input_schema": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "spanish": {"type": "string", "description": "The Spanish text segment."},
-                        "rapanui": {"type": "string", "description": "The Rapanui text segment."}
-                    },
-                    "required": ["spanish", "rapanui"]
-                }
+                "type": "object",
+                "properties": {
+                    "pairs": {
+                        "type": "array",
+                        "description": "Every Spanish-Rapanui text pair found in the image, empty if there are none.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "spanish": {"type": "string", "description": "The Spanish text segment."},
+                                "rapanui": {"type": "string", "description": "The Rapanui text segment."}
+                            },
+                            "required": ["spanish", "rapanui"]
+                        }
+                    }
+                },
+                "required": ["pairs"]
             }
         }
     ]
-}
\ No newline at end of file
+}
+
+
+## Output token budget of each prompt; the others get 1024
+## A label needs a handful of tokens, the pairs of a dense page several thousand
+output_budgets = {
+    "Classifier": 32,
+    "JSON_extractor": 4096,
+}
@@ -0,0 +1,161 @@
+import time
+import random
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 408/409 are transient on both providers, 529 is Anthropic's "overloaded"
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+RATE_LIMIT_STATUS = {429, 529}
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Transient failures (rate limits, overload, timeouts, dropped connections)
+    are worth retrying; bad requests and auth errors are not.
+    """
+    status = get_status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # SDK timeout/connection errors carry no status code
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return get_status_code(error) in RATE_LIMIT_STATUS
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Reads the retry-after hint (in seconds) from the error's HTTP response, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        # HTTP-date values are rare for these APIs, fall back to our own backoff
+        return None
+    return None
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Blocks until `amount` tokens are available and takes them. Returns the time waited."""
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.refill_per_second
+            time.sleep(wait)
+            waited += wait
+
+    def adjust(self, amount: float) -> None:
+        """Adds (or, if negative, removes) tokens without blocking. The balance may go negative."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """
+    Requests/min and tokens/min buckets shared by every worker that talks to
+    the same API. The per-request token estimate follows the `usage` numbers
+    the API returns, and a rate-limit error pauses all workers at once.
+    """
+    _shared: Dict[str, 'RateLimiter'] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, requests_per_minute: float = 50, tokens_per_minute: float = 40000, default_tokens: int = 1500):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self.average_tokens = float(default_tokens)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, name: str, **kwargs) -> 'RateLimiter':
+        """Returns the process-wide limiter registered under `name`, creating it on first use."""
+        with cls._shared_lock:
+            if name not in cls._shared:
+                cls._shared[name] = cls(**kwargs)
+            return cls._shared[name]
+
+    def estimate_tokens(self) -> int:
+        return int(self.average_tokens)
+
+    def acquire(self, tokens: Optional[int] = None) -> int:
+        """Waits for a request slot and token budget. Returns the tokens reserved."""
+        while True:
+            with self._lock:
+                pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+
+        tokens = self.estimate_tokens() if tokens is None else tokens
+        self.requests.acquire(1)
+        self.tokens.acquire(tokens)
+        return tokens
+
+    def record_usage(self, input_tokens: int, output_tokens: int, reserved: int) -> None:
+        """Settles a reservation against the tokens actually billed and updates the estimate."""
+        used = input_tokens + output_tokens
+        self.tokens.adjust(reserved - used)
+        if used > 0:
+            with self._lock:
+                self.average_tokens = 0.9 * self.average_tokens + 0.1 * used
+
+    def release(self, reserved: int) -> None:
+        """Returns the tokens of a request that was never billed."""
+        self.tokens.adjust(reserved)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back every worker sharing this limiter for `seconds`."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning("Rate limited, pausing all requests for %.1fs", seconds)
+
+
+class Backoff:
+    """Exponential backoff with full jitter that never retries sooner than a retry-after hint."""
+    def __init__(self, base: float = 1.0, factor: float = 2.0, max_delay: float = 60.0):
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base * self.factor ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
@@ -0,0 +1,241 @@
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers Anthropic `/v1/messages` and OpenAI `/v1/chat/completions` calls
+    with a fixed answer after a simulated latency, labeled per page when the
+    request packs several images. Requests with tools get a tool call with
+    `tool_input`, and streamed Anthropic requests get their answer word by
+    word, `token_latency` apart. Settings live on the server.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+
+        if random.random() < server.error_rate:
+            self._reply(529, {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})
+            return
+
+        request = json.loads(body)
+        pages = self._count_images(request)
+        answer = server.answer
+        if pages > 1:
+            answer = "\n".join(f"Page {number}: {server.answer}" for number in range(1, pages + 1))
+
+        # Roughly what a base64 image and prompt would be billed
+        input_tokens = len(body) // 1000 + 100
+        output_tokens = max(1, len(answer) // 4)
+        tools = request.get("tools")
+        if not request.get("stream"):
+            # A whole answer takes as long to generate as its streamed words
+            time.sleep(server.token_latency * len(answer.split()))
+        if self.path.endswith("/messages"):
+            if request.get("stream"):
+                self._stream(request, answer, input_tokens, output_tokens)
+                return
+            content = [{"type": "text", "text": answer}]
+            if tools:
+                content = [{"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex}", "name": tools[0]["name"], "input": server.tool_input}]
+            self._reply(200, {
+                "id": f"msg_{uuid.uuid4().hex}",
+                "type": "message",
+                "role": "assistant",
+                "model": request.get("model", "stub"),
+                "content": content,
+                "stop_reason": "tool_use" if tools else "end_turn",
+                "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+            })
+        elif self.path.endswith("/chat/completions"):
+            message = {"role": "assistant", "content": answer}
+            if tools:
+                message = {"role": "assistant", "content": None, "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex}",
+                    "type": "function",
+                    "function": {"name": tools[0]["function"]["name"], "arguments": json.dumps(server.tool_input)},
+                }]}
+            self._reply(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "tool_calls" if tools else "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": input_tokens,
+                    "completion_tokens": output_tokens,
+                    "total_tokens": input_tokens + output_tokens,
+                },
+            })
+        else:
+            self._reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def _stream(self, request: dict, answer: str, input_tokens: int, output_tokens: int) -> None:
+        """Server-sent events of a Messages API stream, one text delta per word."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        events = [
+            ("message_start", {"type": "message_start", "message": {
+                "id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant",
+                "model": request.get("model", "stub"), "content": [], "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+            }}),
+            ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}),
+        ]
+        events += [
+            ("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": word}})
+            for word in re.findall(r"\S+\s*|\s+", answer)
+        ]
+        events += [
+            ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                               "usage": {"output_tokens": output_tokens}}),
+            ("message_stop", {"type": "message_stop"}),
+        ]
+        try:
+            for name, data in events:
+                if name == "content_block_delta":
+                    time.sleep(self.server.token_latency)
+                self.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up early
+            self.server.aborted_streams += 1
+
+    @staticmethod
+    def _count_images(request: dict) -> int:
+        content = request.get("messages", [{}])[-1].get("content", [])
+        if isinstance(content, str):
+            return 0
+        return sum(1 for block in content if block.get("type") in ("image", "image_url"))
+
+    def _reply(self, status: int, payload: dict) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    latency: float = 0.5,
+    jitter: float = 0.1,
+    error_rate: float = 0.0,
+    answer: str = "No Candidate",
+    token_latency: float = 0.0,
+    tool_input: Optional[dict] = None
+) -> Tuple[ThreadingHTTPServer, str]:
+    """Starts a stub server in a background thread. Returns it and its base URL."""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.answer = answer
+    server.token_latency = token_latency
+    server.tool_input = tool_input if tool_input is not None else {"pairs": [{"spanish": "Buenos días", "rapanui": "'Iorana"}]}
+    server.aborted_streams = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def benchmark(
+    folder: str,
+    max_in_flight: int = 16,
+    latency: float = 0.5,
+    error_rate: float = 0.0,
+    telemetry_csv: Optional[str] = None,
+    pages_per_request: int = 1
+):
+    """
+    Runs ClaudeAPI and OpenAIAPI through the concurrent pipeline against one
+    stub server. `pages_per_request` applies to ClaudeAPI, the only backend that packs pages.
+    """
+    from models.claude import ClaudeAPI
+    from models.gpt import OpenAIAPI
+    from utils.pipeline import InferencePipeline
+    from utils.utils import scan_images
+
+    server, url = serve(latency=latency, error_rate=error_rate)
+    files = sorted(scan_images(folder))
+    backends = [
+        ClaudeAPI(model_name="claude-3-5-sonnet-20241022", prompt_type="Classifier", api_key="stub", base_url=url),
+        OpenAIAPI(model_name="gpt-4o", prompt_type="Classifier", api_key="stub", base_url=url + "/v1"),
+    ]
+    try:
+        for model in backends:
+            pages = pages_per_request if isinstance(model, ClaudeAPI) else 1
+            InferencePipeline(
+                model, output_csv=f"stub_{model.model_name}.csv", max_in_flight=max_in_flight, pages_per_request=pages
+            ).run(files)
+            summary = model.telemetry.summary()
+            latency_stats = summary["metrics"]["latency_s"]
+            print(
+                f"{type(model).__name__:<10} {summary['pages']} pages  {summary['images_per_sec'] or 0:.1f} img/s  "
+                f"p50 {latency_stats['p50'] or 0:.3f}s  p95 {latency_stats['p95'] or 0:.3f}s  "
+                f"${summary['cost_per_1k_pages_usd'] or 0:.2f}/1k pages  {summary['failures']} failed"
+            )
+            if telemetry_csv:
+                model.telemetry.export_csv(
+                    telemetry_csv, model=model.model_name, max_in_flight=max_in_flight,
+                    pages_per_request=pages, stub_latency=latency
+                )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Anthropic/OpenAI stub server for benchmarking the backends offline")
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument("--latency", default=0.5, type=float)
+    parser.add_argument("--jitter", default=0.1, type=float)
+    parser.add_argument("--error_rate", default=0.0, type=float)
+    parser.add_argument("--answer", default="No Candidate", type=str)
+    parser.add_argument("--token_latency", default=0.0, type=float, help="Seconds between streamed words")
+    parser.add_argument("--benchmark", default="", type=str, help="Folder of images to run both backends on, then exit")
+    parser.add_argument("--max_in_flight", default=16, type=int)
+    parser.add_argument("--telemetry_csv", default="", type=str)
+    parser.add_argument("--pages_per_request", default=1, type=int)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(
+            args.benchmark, args.max_in_flight, args.latency, args.error_rate,
+            args.telemetry_csv or None, args.pages_per_request
+        )
+    else:
+        server, url = serve(args.host, args.port, args.latency, args.jitter, args.error_rate, args.answer, args.token_latency)
+        print(f"Stub server listening on {url} (Anthropic base URL {url}, OpenAI base URL {url}/v1)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,180 @@
+import os
+import csv
+import json
+import math
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    """Thread-safe collection of samples with percentile summaries."""
+    def __init__(self):
+        self._values: List[float] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._values)
+
+    def add(self, value: float) -> None:
+        with self._lock:
+            self._values.append(float(value))
+
+    def values(self) -> List[float]:
+        with self._lock:
+            return list(self._values)
+
+    def percentile(self, p: float) -> Optional[float]:
+        return self._percentile(sorted(self.values()), p)
+
+    @staticmethod
+    def _percentile(ordered: List[float], p: float) -> Optional[float]:
+        # Linear interpolation between closest ranks
+        if not ordered:
+            return None
+        rank = (len(ordered) - 1) * p / 100
+        low, high = math.floor(rank), math.ceil(rank)
+        return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        ordered = sorted(self.values())
+        summary = {
+            "count": len(ordered),
+            "total": sum(ordered),
+            "mean": sum(ordered) / len(ordered) if ordered else None,
+            "min": ordered[0] if ordered else None,
+            "max": ordered[-1] if ordered else None,
+        }
+        for p in PERCENTILES:
+            summary[f"p{p}"] = self._percentile(ordered, p)
+        return summary
+
+
+class Telemetry:
+    """
+    Per-run request metrics shared by every worker of a model backend.
+    Each completed request adds one sample per metric and counts the pages
+    it answered, one unless several pages were packed together. Cache hits
+    count as pages but add no latency, token or cost samples. The estimated
+    input tokens are sampled before each request is sent.
+    """
+    METRICS = (
+        "latency_s", "retries", "input_tokens", "output_tokens", "bytes_uploaded", "cost_usd",
+        "estimated_input_tokens",
+    )
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {name: Histogram() for name in self.METRICS}
+        self._lock = threading.Lock()
+        self.pages = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.hedge_cost = 0.0
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    def start(self) -> float:
+        """Marks the start of a request and returns its start time."""
+        now = time.perf_counter()
+        with self._lock:
+            if self._started_at is None:
+                self._started_at = now
+        return now
+
+    def record(
+        self,
+        start_time: float,
+        retries: int = 0,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        bytes_uploaded: int = 0,
+        cost: float = 0.0,
+        failed: bool = False,
+        pages: int = 1
+    ) -> None:
+        now = time.perf_counter()
+        samples = {
+            "latency_s": now - start_time,
+            "retries": retries,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "bytes_uploaded": bytes_uploaded,
+            "cost_usd": cost,
+        }
+        for name, value in samples.items():
+            self.histograms[name].add(value)
+        with self._lock:
+            self.pages += pages
+            self.failures += pages if failed else 0
+            self._finished_at = now
+
+    def record_estimate(self, input_tokens: int) -> None:
+        """Input tokens a request is expected to cost, recorded before it is sent."""
+        self.histograms["estimated_input_tokens"].add(input_tokens)
+
+    def record_cache_hit(self) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            if self._started_at is None:
+                self._started_at = now
+            self.pages += 1
+            self.cache_hits += 1
+            self._finished_at = now
+
+    def record_hedge(self, won: bool) -> None:
+        with self._lock:
+            self.hedges += 1
+            self.hedges_won += won
+
+    def record_hedge_cost(self, cost: float) -> None:
+        """Cost of a duplicate request, billed on top of the page's own cost."""
+        with self._lock:
+            self.hedge_cost += cost
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            pages, failures, cache_hits = self.pages, self.failures, self.cache_hits
+            hedges, hedges_won, hedge_cost = self.hedges, self.hedges_won, self.hedge_cost
+            elapsed = (self._finished_at - self._started_at) if self._finished_at is not None else 0.0
+        metrics = {name: histogram.summary() for name, histogram in self.histograms.items()}
+        total_cost = metrics["cost_usd"]["total"] + hedge_cost
+        return {
+            "pages": pages,
+            "failures": failures,
+            "cache_hits": cache_hits,
+            "hedges": hedges,
+            "hedges_won": hedges_won,
+            "elapsed_s": elapsed,
+            "images_per_sec": pages / elapsed if elapsed > 0 else None,
+            "total_cost_usd": total_cost,
+            "cost_per_1k_pages_usd": total_cost / pages * 1000 if pages else None,
+            "metrics": metrics,
+        }
+
+    def export_json(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def export_csv(self, path: str, **run_info: Any) -> None:
+        """
+        Appends the summary as one flat row, so runs with different settings
+        (passed as `run_info`) can be compared side by side.
+        """
+        summary = self.summary()
+        row = dict(run_info)
+        row.update({key: value for key, value in summary.items() if key != "metrics"})
+        for name, stats in summary["metrics"].items():
+            for stat in ["mean"] + [f"p{p}" for p in PERCENTILES] + ["max"]:
+                row[f"{name}_{stat}"] = stats[stat]
+
+        file_exists = os.path.isfile(path)
+        with open(path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+            if not file_exists:
+                writer.writeheader()
+            writer.writerow(row)
@@ -1,13 +1,63 @@
 import os
 import csv
+import zlib
+import logging
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.webp')
 
 def get_list(folder):
     """
     Get a list of images from a folder
     """
-    exts = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.webp')
-    return [os.path.join(folder, img) for img in os.listdir(folder) 
-            if os.path.isfile(os.path.join(folder, img)) and img.lower().endswith(exts)]
+    return list(scan_images(folder))
+
+def scan_images(folder, recursive=False, extensions=IMAGE_EXTENSIONS, shard_index=0, shard_count=1):
+    """
+    Lazily yield image paths under a folder using os.scandir, so work can start
+    on the first file while the rest of the directory is still being listed.
+    With `shard_count` > 1, only paths whose crc32 (of the path relative to
+    `folder`) falls in `shard_index` are yielded, so several workers can split
+    one folder without coordinating.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"shard_index must be in [0, {shard_count}), got {shard_index}.")
+    extensions = tuple(ext.lower() for ext in extensions)
+    pending = [folder]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # DirEntry caches the file type from the listing, no extra stat per entry
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            pending.append(entry.path)
+                        continue
+                    if not entry.name.lower().endswith(extensions) or not entry.is_file():
+                        continue
+                    if shard_count > 1:
+                        relative = os.path.relpath(entry.path, folder)
+                        if zlib.crc32(relative.encode("utf-8")) % shard_count != shard_index:
+                            continue
+                    yield entry.path
+        except OSError as e:
+            if directory == folder:
+                raise
+            logger.warning("Skipping unreadable directory %s: %s", directory, e)
+
+def chunked(iterable, size):
+    """
+    Yield successive lists of at most `size` items without materializing the iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 def save_to_csv(file_path, data, headers, mode='a'):
     """
@@ -38,19 +88,29 @@ def calculate_metrics(results_csv, pairs_candidates_folder="pairs_candidates", s
         pairs_candidates_folder: "Candidate",
         sources_traductor_folder: "No Candidate"
     }
+
+    # Pages answered by the local prefilter instead of the API
+    rows_seen = 0
+    prefilter = {"total": 0, "labelled": 0, "correct": 0}
     
     with open(results_csv, mode='r') as file:
         reader = csv.DictReader(file)
         for row in reader:
             folder = row["Folder"]
             predicted_answer = row["Answer"]
+            rows_seen += 1
             
             expected_answer = expected_answers.get(folder, None)
+            from_prefilter = row.get("Source") == "prefilter"
+            prefilter["total"] += from_prefilter
             
             if expected_answer is not None:
                 metrics[folder]["total"] += 1
                 if predicted_answer == expected_answer:
                     metrics[folder]["correct"] += 1
+                if from_prefilter:
+                    prefilter["labelled"] += 1
+                    prefilter["correct"] += predicted_answer == expected_answer
 
     total_images = sum(folder_metrics["total"] for folder_metrics in metrics.values())
     correct_predictions = sum(folder_metrics["correct"] for folder_metrics in metrics.values())
@@ -74,3 +134,12 @@ def calculate_metrics(results_csv, pairs_candidates_folder="pairs_candidates", s
     print(f"Total Images: {total_images}")
     print(f"Correct Predictions: {correct_predictions}")
     print(f"Overall Accuracy: {overall_accuracy * 100:.2f}%")
+
+    if prefilter["total"]:
+        wrong = prefilter["labelled"] - prefilter["correct"]
+        print("\nPrefilter:")
+        print(f"API calls saved: {prefilter['total']} of {rows_seen} ({prefilter['total'] / rows_seen * 100:.2f}%)")
+        if prefilter["labelled"]:
+            print(f"  Prefilter Accuracy: {prefilter['correct'] / prefilter['labelled'] * 100:.2f}% ({prefilter['labelled']} labelled pages)")
+        # Each wrong local decision is an error the API might have avoided
+        print(f"  Accuracy cost: at most {wrong / total_images * 100 if total_images else 0:.2f} points ({wrong} wrong local decisions)")